@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""
+Benchmark of the source × dataset coverage cross-match
+
+Measures the number of sources per second matched by cds.crossmatch.coverage_matrix
+against the MOCs of random cone datasets, in one process and in several processes.
+
+Run with :
+
+    python -m benchmarks.bench_coverage_matrix
+"""
+
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from astropy.coordinates import SkyCoord, Angle
+
+from cds.spatial_constraints import Cone
+from cds.moc_store import MocStore
+from cds.crossmatch import coverage_matrix
+
+N_SOURCES = 4000000
+N_DATASETS = 200
+MOC_ORDER = 9
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    centers = SkyCoord(rng.uniform(0, 360, N_DATASETS), rng.uniform(-60, 60, N_DATASETS), unit='deg')
+    cones = Cone.from_arrays(centers, Angle(rng.uniform(0.5, 10, N_DATASETS), unit='deg'))
+    path = os.path.join(tempfile.mkdtemp(), 'store')
+    store = MocStore.write(path, (('D{0}'.format(i), cone.healpix_ranges(MOC_ORDER)) for i, cone in enumerate(cones)),
+                           moc_order=MOC_ORDER)
+
+    sources = SkyCoord(rng.uniform(0, 360, N_SOURCES), np.degrees(np.arcsin(rng.uniform(-1, 1, N_SOURCES))),
+                       unit='deg')
+
+    print('{0} sources, {1} datasets'.format(N_SOURCES, N_DATASETS))
+    for n_processes in (1, os.cpu_count()):
+        start = time.time()
+        matrix = coverage_matrix(sources, store, chunk_size=500000, n_processes=n_processes)
+        duration = time.time() - start
+        print('{0} process(es) : {1:.2f}s, {2:.2f} million sources per second, {3} matches'.format(
+            n_processes, duration, N_SOURCES / duration / 1e6, len(matrix.indices)))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""
+Benchmark of the memory footprint of the Dataset records
+
+Compares the former storage of the records, where each Dataset held its own
+dict of properties and created its pyvo services when instantiated, with the
+compact cds.dataset.Dataset storage.
+
+Run with :
+
+    python -m benchmarks.bench_dataset_memory
+"""
+
+import gc
+import json
+import tracemalloc
+
+import pyvo as vo
+
+from cds.dataset import Dataset
+
+N_RECORDS = 30000
+N_PROPERTIES = 100
+
+
+class LegacyDataset(object):
+    """Storage of the records before the compact Dataset"""
+
+    def __init__(self, **kwargs):
+        self.properties = kwargs
+        self.services = {}
+        for name, service_class in (('tap', vo.dal.TAPService), ('cs', vo.dal.SCSService)):
+            if name + '_service_url' in kwargs:
+                self.services[name] = [service_class(kwargs[name + '_service_url'])]
+
+
+def make_records(n_records):
+    records = []
+    for i in range(n_records):
+        record = {
+            'ID': 'CDS/B/{0}/table{1}'.format(i // 10, i),
+            'tap_service_url': 'http://tapvizier.u-strasbg.fr/TAPVizieR/tap',
+            'cs_service_url': 'http://vizier.u-strasbg.fr/viz-bin/conesearch/B/{0}?'.format(i),
+        }
+        for j in range(N_PROPERTIES - len(record)):
+            record['property_{0}'.format(j)] = float(i * j)
+        # the records are decoded from json like the responses of the MOCServer,
+        # so the property names are not shared between records
+        records.append(json.loads(json.dumps(record)))
+    return records
+
+
+def measure(dataset_class):
+    records = make_records(N_RECORDS)
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+
+    datasets = [dataset_class(**record) for record in records]
+    del records
+    gc.collect()
+
+    end = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in end.compare_to(start, 'filename'))
+    del datasets
+    return size
+
+
+if __name__ == '__main__':
+    legacy = measure(LegacyDataset)
+    compact = measure(Dataset)
+
+    print('{0} records of {1} properties'.format(N_RECORDS, N_PROPERTIES))
+    print('dict per record    : {0:.0f} bytes per record'.format(legacy / N_RECORDS))
+    print('compact records    : {0:.0f} bytes per record ({1:.1f}x smaller)'.format(compact / N_RECORDS,
+                                                                                   legacy / compact))
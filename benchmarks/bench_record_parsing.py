@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""
+Benchmark of the parsing of the records sent by the MOCServer
+
+Compares the former parsing, trying to convert every value to a float and
+catching the exception raised by the non numeric ones, with the parsing by
+property type of cds.property_types.PropertyTypeRegistry.
+
+The records are generated to have the size of the record results of
+cds/tests/data/properties.json, i.e. a few thousand datasets.
+
+Run with :
+
+    python -m benchmarks.bench_record_parsing
+"""
+
+import random
+import timeit
+
+from cds.property_types import PropertyTypeRegistry
+
+N_RECORDS = 3000
+
+
+def make_records(n_records):
+    rng = random.Random(0)
+    records = []
+    for i in range(n_records):
+        record = {'ID': 'CDS/B/{0}/table{1}'.format(i // 10, i)}
+        for j in range(20):
+            record['numeric_prop_{0}'.format(j)] = str(rng.uniform(-1000, 1000))
+        for j in range(20):
+            record['string_prop_{0}'.format(j)] = 'value {0} of record {1}'.format(j, i)
+        for j in range(5):
+            record['list_prop_{0}'.format(j)] = ['http://mirror{0}.org/{1}'.format(k % 3, i) for k in range(4)]
+        records.append(record)
+    return records
+
+
+def legacy_parse(records):
+    def parse_to_float(value):
+        try:
+            return float(value)
+        except Exception:
+            return value
+
+    def remove_duplicate(value_l):
+        if isinstance(value_l, list):
+            value_l = list(set(value_l))
+            if len(value_l) == 1:
+                return value_l[0]
+        return value_l
+
+    parsed = [dict([k, parse_to_float(v)] for k, v in d.items()) for d in records]
+    return [dict([k, remove_duplicate(d.get(k))] for k in d.keys()) for d in parsed]
+
+
+# shared by the runs like CdsClass.property_types is shared by the queries
+registry = PropertyTypeRegistry()
+
+
+def typed_parse(records):
+    return [registry.parse(record) for record in records]
+
+
+if __name__ == '__main__':
+    records = make_records(N_RECORDS)
+    n_runs = 5
+    legacy = min(timeit.repeat(lambda: legacy_parse(records), number=1, repeat=n_runs))
+    typed = min(timeit.repeat(lambda: typed_parse(records), number=1, repeat=n_runs))
+
+    print('{0} records of {1} properties'.format(N_RECORDS, len(records[0])))
+    print('try/except float parsing : {0:.3f} s'.format(legacy))
+    ratio = legacy / typed
+    print('typed parsing            : {0:.3f} s ({1:.1f}x {2})'.format(
+        typed, ratio if ratio >= 1 else 1 / ratio, 'faster' if ratio >= 1 else 'slower'))
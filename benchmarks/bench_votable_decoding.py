@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""
+Benchmark of the decoding of large DAL results
+
+Compares the parsing by astropy of a cone search result serialized in TABLEDATA
+(the default of the services) and in BINARY2 with the direct decoding of the
+BINARY2 serialization by cds.binary_votable.decode_votable.
+
+Run with :
+
+    python -m benchmarks.bench_votable_decoding
+"""
+
+import io
+import time
+
+import numpy as np
+
+from astropy.io import votable
+from astropy.table import Table
+
+from cds.binary_votable import decode_votable
+
+N_ROWS = 300000
+
+
+def make_votable(tabledata_format):
+    rng = np.random.RandomState(0)
+    table = Table({
+        'source_id': np.arange(N_ROWS, dtype=np.int64),
+        'ra': rng.uniform(0, 360, N_ROWS),
+        'dec': rng.uniform(-90, 90, N_ROWS),
+        'gmag': rng.uniform(5, 21, N_ROWS).astype(np.float32),
+        'flags': rng.randint(0, 100, N_ROWS).astype(np.int32),
+    })
+    content = io.BytesIO()
+    votable.from_table(table).to_xml(content, tabledata_format=tabledata_format)
+    return content.getvalue()
+
+
+def measure(decode, content):
+    start = time.time()
+    table = decode(content)
+    duration = time.time() - start
+    assert len(table) == N_ROWS
+    return duration
+
+
+if __name__ == '__main__':
+    tabledata = make_votable('tabledata')
+    binary2 = make_votable('binary2')
+
+    def astropy_parse(content):
+        return votable.parse(io.BytesIO(content)).get_first_table().to_table()
+
+    print('{0} rows'.format(N_ROWS))
+    for name, decode, content in (('astropy, TABLEDATA', astropy_parse, tabledata),
+                                  ('astropy, BINARY2  ', astropy_parse, binary2),
+                                  ('numpy, BINARY2    ', decode_votable, binary2)):
+        duration = measure(decode, content)
+        print('{0} : {1:.3f}s, response of {2:.1f} MB'.format(name, duration, len(content) / 1024 ** 2))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""
+Decoding of the VOTables returned by the DAL services into astropy Tables
+
+The rows of a VOTable serialized in BINARY2 whose fields all have a fixed size
+are laid out as the records of a numpy structured array : a bitmask of the
+null fields followed by the big-endian values of the fields. Such a table is
+decoded with a single `numpy.frombuffer` call instead of building the VOTable
+object tree of astropy cell by cell. The other VOTables (TABLEDATA, variable
+length fields...) are parsed by astropy.
+"""
+
+import base64
+import io
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+import pyvo as vo
+
+from astropy import units as u
+from astropy.io import votable
+from astropy.table import Table, Column, MaskedColumn
+
+# The value of the DALI RESPONSEFORMAT parameter asking for the BINARY2 serialization
+BINARY2_MIME_TYPE = 'application/x-votable+xml;serialization=BINARY2'
+
+_DATATYPES = {
+    'boolean': 'S1',
+    'unsignedByte': 'u1',
+    'short': '>i2',
+    'int': '>i4',
+    'long': '>i8',
+    'char': 'S1',
+    'unicodeChar': '>u2',
+    'float': '>f4',
+    'double': '>f8',
+    'floatComplex': '>c8',
+    'doubleComplex': '>c16',
+}
+
+
+def _local_name(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _children(element, name):
+    return [child for child in element if _local_name(child) == name]
+
+
+def _field_dtype(field):
+    """The numpy dtype of a fixed-size field, None if its values have a variable size"""
+    datatype = field.get('datatype')
+    arraysize = field.get('arraysize')
+    if datatype not in _DATATYPES:
+        return None
+    if arraysize is None:
+        return np.dtype(_DATATYPES[datatype])
+    if not arraysize.isdigit():
+        # variable length ('*', '10*') and multidimensional ('2x3') arrays
+        return None
+    if datatype == 'char':
+        return np.dtype('S' + arraysize)
+    if datatype == 'unicodeChar':
+        return np.dtype(('>u2', (int(arraysize),)))
+    return np.dtype((_DATATYPES[datatype], (int(arraysize),)))
+
+
+def _raise_query_error(infos):
+    # infos are (name, value, text) tuples
+    for name, value, text in infos:
+        if name == 'QUERY_STATUS' and value == 'ERROR':
+            raise vo.dal.DALQueryError((text or '').strip() or 'The query failed')
+
+
+def _check_query_status(root):
+    _raise_query_error((element.get('name'), element.get('value'), element.text)
+                       for element in root.iter() if _local_name(element) == 'INFO')
+
+
+def _first_serialization(content):
+    """
+    The serialization of the first table (e.g. 'BINARY2' or 'TABLEDATA'), None if there is no data
+
+    The document is only parsed up to the first child of its first DATA element.
+    """
+    in_data = False
+    for _, element in ElementTree.iterparse(io.BytesIO(content), events=('start',)):
+        if in_data:
+            return _local_name(element)
+        in_data = _local_name(element) == 'DATA'
+    return None
+
+
+def decode_votable(content):
+    """
+    Decode the first table of a VOTable document
+
+    Parameters
+    ----------
+    content : bytes
+        The VOTable document, as returned by a DAL service
+
+    Returns
+    -------
+    table : `~astropy.table.Table`
+    """
+    # the other serializations are parsed by astropy without building the element tree first
+    if _first_serialization(content) == 'BINARY2':
+        root = ElementTree.fromstring(content)
+        _check_query_status(root)
+
+        table_element = next((element for element in root.iter() if _local_name(element) == 'TABLE'), None)
+        table = _decode_binary2(table_element) if table_element is not None else None
+        if table is not None:
+            return table
+
+    result = votable.parse(io.BytesIO(content))
+    _raise_query_error((info.name, info.value, info.content) for info in result.iter_info())
+    return result.get_first_table().to_table()
+
+
+def _decode_binary2(table_element):
+    fields = _children(table_element, 'FIELD')
+    data = _children(table_element, 'DATA')
+    binary2 = _children(data[0], 'BINARY2') if data else []
+    stream = _children(binary2[0], 'STREAM') if binary2 else []
+    if not fields or not stream or stream[0].get('encoding') != 'base64' or stream[0].get('href'):
+        return None
+
+    dtypes = [_field_dtype(field) for field in fields]
+    if any(dtype is None for dtype in dtypes):
+        return None
+
+    n_flag_bytes = -(-len(fields) // 8)
+    row_dtype = np.dtype([('flags', 'u1', (n_flag_bytes,))] +
+                         [('f{0}'.format(i), dtype) for i, dtype in enumerate(dtypes)])
+    raw = base64.b64decode(stream[0].text or '')
+    if len(raw) % row_dtype.itemsize:
+        return None
+    rows = np.frombuffer(raw, dtype=row_dtype)
+
+    # bit i of the flags (most significant bit first) tells whether the field i is null
+    nulls = np.unpackbits(rows['flags'], axis=1)[:, :len(fields)].astype(bool)
+
+    columns = []
+    for i, field in enumerate(fields):
+        values = rows['f{0}'.format(i)]
+        null = nulls[:, i]
+        datatype = field.get('datatype')
+        if datatype == 'boolean':
+            null = null | ~np.isin(values, [b'T', b't', b'1', b'F', b'f', b'0'])
+            values = np.isin(values, [b'T', b't', b'1'])
+        elif datatype == 'char':
+            values = values.astype('U')
+        elif datatype == 'unicodeChar':
+            # UCS-2 code units widened to the UCS-4 strings of numpy
+            codes = values.reshape(len(values), -1).astype(np.uint32)
+            values = np.ascontiguousarray(codes).view('U{0}'.format(codes.shape[1])).reshape(len(values))
+        else:
+            # the values are converted to the native byte order once
+            values = values.astype(values.dtype.newbyteorder('='))
+
+        unit = field.get('unit')
+        kwargs = dict(name=field.get('name') or field.get('ID') or 'col{0}'.format(i),
+                      unit=u.Unit(unit, format='vounit', parse_strict='silent') if unit else None)
+        description = _children(field, 'DESCRIPTION')
+        if description:
+            kwargs['description'] = (description[0].text or '').strip()
+
+        if null.any():
+            mask = null if values.ndim == 1 else np.broadcast_to(null[:, None], values.shape)
+            columns.append(MaskedColumn(values, mask=mask, **kwargs))
+        else:
+            columns.append(Column(values, **kwargs))
+
+    return Table(columns)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""
+Bulk queries of the MOCServer for a list of targets
+
+The targets are read from a CSV or FITS file in chunks of ``chunk_size`` rows.
+The datasets matching the cone around each target of a chunk are queried
+concurrently, optionally followed by a search in each of these datasets, and
+the rows of the chunk are written to their own part file. A checkpoint file
+records the number of chunks done so that an interrupted run resumes after
+the last part written. Only one chunk is held in memory at a time.
+
+Run ``python -m astroquery.cds --help`` for the list of the options.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.table import Table
+
+from .spatial_constraints import Cones
+from .property_constraint import PropertyConstraint
+from .output_format import OutputFormat
+from .dataset import Dataset
+
+CHECKPOINT_FILENAME = 'checkpoint.json'
+
+
+def read_target_chunks(filename, ra_column, dec_column, chunk_size, radius_column=None):
+    """
+    Read the positions of the targets of a CSV or FITS file, ``chunk_size`` rows at a time
+
+    Yields
+    ------
+    ra, dec, radius : `~numpy.ndarray`
+        The positions (and radii if ``radius_column`` is given, None otherwise) of the
+        targets of a chunk, in degrees
+    """
+    columns = [ra_column, dec_column] + ([radius_column] if radius_column else [])
+
+    if filename.lower().endswith(('.fits', '.fit', '.fits.gz')):
+        with fits.open(filename, memmap=True) as hdul:
+            hdu = next((hdu for hdu in hdul if isinstance(hdu, fits.BinTableHDU)), None)
+            if hdu is None:
+                print("{0} has no binary table of targets".format(filename))
+                raise ValueError
+            for start in range(0, hdu.header['NAXIS2'], chunk_size):
+                # only the rows of the chunk are read from the memory mapped table
+                rows = hdu.data[start:start + chunk_size]
+                arrays = [np.array(rows[column], dtype=np.float64) for column in columns]
+                yield arrays[0], arrays[1], arrays[2] if radius_column else None
+    else:
+        with open(filename, newline='') as f_in:
+            reader = csv.DictReader(f_in)
+            while True:
+                rows = list(islice(reader, chunk_size))
+                if not rows:
+                    break
+                arrays = [np.array([row[column] for row in rows], dtype=np.float64) for column in columns]
+                yield arrays[0], arrays[1], arrays[2] if radius_column else None
+
+
+def write_part(table, filename, output_format):
+    if output_format == 'parquet':
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("Writing Parquet files requires pyarrow. Install it or use --output-format fits")
+            raise
+
+        pyarrow.parquet.write_table(pyarrow.table(dict((name, table[name].data) for name in table.colnames)),
+                                    filename)
+    else:
+        table.write(filename, format='fits', overwrite=True)
+
+
+def load_checkpoint(output_dir, targets, chunk_size):
+    """The number of chunks done by a previous run writing to ``output_dir``"""
+    filename = os.path.join(output_dir, CHECKPOINT_FILENAME)
+    if not os.path.exists(filename):
+        return 0
+
+    with open(filename, 'r') as f_in:
+        checkpoint = json.load(f_in)
+    if checkpoint['targets'] != os.path.abspath(targets) or checkpoint['chunk_size'] != chunk_size:
+        print("{0} holds the results of another run. Use another output directory".format(output_dir))
+        raise ValueError
+    return checkpoint['chunks_done']
+
+
+def save_checkpoint(output_dir, targets, chunk_size, chunks_done):
+    filename = os.path.join(output_dir, CHECKPOINT_FILENAME)
+    with open(filename + '.tmp', 'w') as f_out:
+        json.dump({'targets': os.path.abspath(targets), 'chunk_size': chunk_size, 'chunks_done': chunks_done},
+                  f_out)
+    os.replace(filename + '.tmp', filename)
+
+
+def search_datasets(pairs, service_type, search_radius, max_workers, search_dir):
+    """
+    Search each dataset around its target
+
+    The VOTables found are written in ``search_dir``.
+
+    Returns
+    -------
+    n_rows : [int]
+        The number of sources found for each (target, position, dataset) of ``pairs``,
+        -1 if the search failed
+    """
+    size_param = Dataset.search_size_params[service_type]
+    # the size of a SIA search is the width of the square around the position and the one
+    # of a SSA search the diameter of the circle, i.e. twice the radius of the region
+    size = search_radius if size_param == 'radius' else 2 * search_radius
+
+    def search(pair):
+        target, position, dataset_id, dataset = pair
+        try:
+            votable = dataset.search(service_type, **{'pos': position, size_param: size})
+        except Exception as error:
+            print('Search of {0} around target {1} failed : {2}'.format(dataset_id, target, error),
+                  file=sys.stderr)
+            return -1
+
+        filename = '{0}_{1}.xml'.format(target, dataset_id.replace('/', '_'))
+        votable.to_xml(os.path.join(search_dir, filename))
+        return len(votable.get_first_table().array)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(search, pairs))
+
+
+def run(targets, output_dir, radius, ra_column='ra', dec_column='dec', radius_column=None,
+        intersect='overlaps', properties=None, fields=None, search=None, search_radius=None,
+        chunk_size=1000, max_workers=8, output_format='parquet', cds=None):
+    """
+    Query the datasets matching each target of a file and write them to part files
+
+    Each part file holds one row per (target, dataset) with the columns ``target`` (the
+    index of the target in the input file), ``ID`` and the requested ``fields``, plus
+    ``n_search_rows`` when the datasets are searched.
+
+    Returns
+    -------
+    n_chunks : int
+        The number of chunks written by this run
+    """
+    if cds is None:
+        from .core import cds
+
+    if search is not None:
+        search = Dataset.ServiceType[search]
+    fields = list(fields or [])
+    # the URL of the service searched is retrieved along with the fields
+    service_fields = ['{0}_service_url'.format(search.name)] if search is not None else []
+    output_format_obj = OutputFormat(format=OutputFormat.Type.record, field_l=['ID'] + fields + service_fields)
+    properties_constraint = PropertyConstraint(properties) if properties else None
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    search_dir = os.path.join(output_dir, 'search')
+    if search is not None and not os.path.exists(search_dir):
+        os.makedirs(search_dir)
+
+    chunks_done = load_checkpoint(output_dir, targets, chunk_size)
+    extension = 'parquet' if output_format == 'parquet' else 'fits'
+    start_time = time.time()
+    n_chunks = 0
+
+    chunks = read_target_chunks(targets, ra_column, dec_column, chunk_size, radius_column)
+    for i_chunk, (ra, dec, radii) in enumerate(chunks):
+        if i_chunk < chunks_done:
+            continue
+
+        positions = SkyCoord(ra=ra * u.deg, dec=dec * u.deg, frame='icrs')
+        cones = Cones(positions, (radii if radii is not None else radius) * u.deg, intersect=intersect)
+        results = cds.query_regions(cones, output_format_obj, properties_constraint=properties_constraint,
+                                    max_workers=max_workers)
+
+        first_target = i_chunk * chunk_size
+        rows = [(first_target + i, dataset_id, dataset)
+                for i, datasets in enumerate(results) for dataset_id, dataset in datasets.items()]
+
+        columns = {
+            'target': np.array([row[0] for row in rows], dtype=np.int64),
+            'ID': np.array([row[1] for row in rows], dtype=str),
+        }
+        for field in fields:
+            columns[field] = np.array([str(row[2].properties.get(field, '')) for row in rows], dtype=str)
+        if search is not None:
+            pairs = [(target, positions[target - first_target], dataset_id, dataset)
+                     for target, dataset_id, dataset in rows]
+            columns['n_search_rows'] = np.array(
+                search_datasets(pairs, search, search_radius * u.deg, max_workers, search_dir), dtype=np.int64)
+
+        table = Table(columns, names=list(columns.keys()))
+        write_part(table, os.path.join(output_dir, 'part-{0:05d}.{1}'.format(i_chunk, extension)), output_format)
+        save_checkpoint(output_dir, targets, chunk_size, i_chunk + 1)
+        n_chunks += 1
+
+        print('chunk {0} : {1} targets, {2} rows, {3:.1f}s elapsed'.format(
+            i_chunk, len(ra), len(rows), time.time() - start_time), file=sys.stderr)
+
+    return n_chunks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m astroquery.cds',
+        description='Query the MOCServer datasets matching each target of a CSV or FITS file')
+    parser.add_argument('targets', help='CSV or FITS file of the targets')
+    parser.add_argument('output_dir', help='directory of the part files and of the checkpoint')
+    parser.add_argument('--ra-column', default='ra', help='column of the right ascensions in degrees')
+    parser.add_argument('--dec-column', default='dec', help='column of the declinations in degrees')
+    parser.add_argument('--radius', type=float, default=1. / 60, help='radius of the cones in degrees')
+    parser.add_argument('--radius-column', help='column of the radii of the cones in degrees')
+    parser.add_argument('--intersect', default='overlaps', choices=['overlaps', 'enclosed', 'covers'])
+    parser.add_argument('--properties', help='properties constraint, e.g. "moc_sky_fraction<0.1"')
+    parser.add_argument('--fields', nargs='*', default=[], help='properties of the datasets to write')
+    parser.add_argument('--search', choices=sorted(service_type.name for service_type in Dataset.search_size_params),
+                        help='search each dataset around its target with this type of service')
+    parser.add_argument('--search-radius', type=float, default=1. / 60,
+                        help='radius of the region searched in the datasets in degrees')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='number of targets of each part file')
+    parser.add_argument('--max-workers', type=int, default=8, help='number of concurrent queries')
+    parser.add_argument('--output-format', default='parquet', choices=['parquet', 'fits'])
+    args = parser.parse_args(argv)
+
+    return run(args.targets, args.output_dir, args.radius, ra_column=args.ra_column, dec_column=args.dec_column,
+               radius_column=args.radius_column, intersect=args.intersect, properties=args.properties,
+               fields=args.fields, search=args.search, search_radius=args.search_radius,
+               chunk_size=args.chunk_size, max_workers=args.max_workers, output_format=args.output_format)
@@ -4,16 +4,19 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 
 from .spatial_constraints import SpatialConstraint
+from .temporal_constraints import TemporalConstraint, SpaceTimeMoc
 from .property_constraint import PropertyConstraint
 
 
 class Constraints(object):
-    def __init__(self, sc=None, pc=None):
+    def __init__(self, sc=None, pc=None, tc=None):
         self.__payload = {}
         self.__spatial_constraint = None
         self.__properties_constraint = None
+        self.__temporal_constraint = None
         self.spatial_constraint = sc
         self.properties_constraint = pc
+        self.temporal_constraint = tc
 
     # Ensure the payload cannot be set
     @property
@@ -31,9 +34,30 @@ class Constraints(object):
         if sc and not isinstance(sc, SpatialConstraint):
             raise TypeError
 
+        self.__check_region(sc, self.__temporal_constraint)
         self.__spatial_constraint = sc
         self.__build_new_payload()
 
+    @property
+    def temporal_constraint(self):
+        return self.__temporal_constraint
+
+    @temporal_constraint.setter
+    def temporal_constraint(self, tc):
+        if tc and not isinstance(tc, TemporalConstraint):
+            raise TypeError
+
+        self.__check_region(self.__spatial_constraint, tc)
+        self.__temporal_constraint = tc
+        self.__build_new_payload()
+
+    @staticmethod
+    def __check_region(sc, tc):
+        # A space-time MOC defines the sky region of the query too
+        if sc and isinstance(tc, SpaceTimeMoc):
+            print("A space-time MOC constraint cannot be combined with a spatial constraint")
+            raise ValueError
+
     @property
     def properties_constraint(self):
         return self.__properties_constraint
@@ -51,5 +75,8 @@ class Constraints(object):
         if self.__spatial_constraint:
             self.__payload.update(self.__spatial_constraint.request_payload)
 
+        if self.__temporal_constraint:
+            self.__payload.update(self.__temporal_constraint.request_payload)
+
         if self.__properties_constraint:
             self.__payload.update(self.__properties_constraint.request_payload)
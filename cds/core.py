@@ -5,9 +5,11 @@
 
 # put all imports organized as shown below
 # 1. standard library imports
+import io
+from concurrent.futures import ThreadPoolExecutor
+from pprint import pprint
 
 # 2. third party imports
-from pprint import pprint
 
 # 3. local imports - use relative imports
 # commonly required local imports shown below as example
@@ -18,15 +20,19 @@ from astroquery.utils import commons
 # async_to_sync generates the relevant query tools from _async methods
 from astroquery.utils import async_to_sync
 
-from mocpy import MOC
-from mocpy.interval_set import IntervalSet
-
 # import configurable items declared in __init__.py
 from . import conf
 # import MOCServerConstraints and MOCServerResults
 from .constraints import Constraints
+from .property_constraint import PropertyConstraint
+from .spatial_constraints import Cones
 from .output_format import OutputFormat
-from .dataset import Dataset
+from .dataset import Dataset, LazyRecordPage
+from .property_types import PropertyTypeRegistry
+from . import moc_utils
+from . import rate_limit
+from .moc_cache import MocPyramidCache
+from .moc_reduction import combine_mocs
 
 
 # export all the public classes and methods
@@ -48,6 +54,13 @@ class CdsClass(BaseQuery):
     # TIMEOUT, etc.
     URL = conf.server
     TIMEOUT = conf.timeout
+    # The types of the dataset properties, shared by all the queries
+    property_types = PropertyTypeRegistry()
+    # Bounds the rate and the concurrency of the requests, shared with the dataset searches
+    limiter = rate_limit.limiter
+    # A MocPyramidCache keeping the union MOCs fetched, from which the MOCs of coarser
+    # orders are derived locally. The MOCs are not cached by default
+    moc_cache = None
 
     # all query methods are implemented with an "async" method that handles
     # making the actual HTTP request and returns the raw HTTP response, which
@@ -74,23 +87,42 @@ class CdsClass(BaseQuery):
     # similarly we write a query_region_async method that makes the
     # actual HTTP request and returns the HTTP response
     def query_region(self, constraints, output_format=OutputFormat(), get_query_payload=False):
+        if output_format.format is OutputFormat.Type.moc and not get_query_payload:
+            return self.__query_moc(constraints, output_format)
+
         response = self.query_region_async(constraints, output_format, get_query_payload)
 
         if get_query_payload:
             return response
 
         result = CdsClass.__parse_result_region(response, output_format)
+        if output_format.lazy:
+            self.__make_lazy(result)
 
         return result
 
-    @staticmethod
-    def __remove_duplicate(value_l):
-        if isinstance(value_l, list):
-            value_l = list(set(value_l))
-            if len(value_l) == 1:
-                return value_l[0]
+    def __query_moc(self, constraints, output_format):
+        # A union MOC coarser than one already fetched for the same constraints
+        # is degraded locally instead of being requested again
+        request_payload = self.query_region_async(constraints, output_format, get_query_payload=True)
+        cacheable = self.moc_cache is not None and MocPyramidCache.cacheable(request_payload)
+        if cacheable:
+            ranges = self.moc_cache.get(request_payload)
+            if ranges is not None:
+                return moc_utils.ranges_to_moc(ranges)
+
+        response = self.query_region_async(constraints, output_format, get_query_payload=False)
+        result = CdsClass.__parse_result_region(response, output_format)
+        if cacheable:
+            self.moc_cache.put(request_payload, moc_utils.moc_to_ranges(result))
+        return result
 
-        return value_l
+    def __make_lazy(self, datasets):
+        # All the datasets of the result share one page so that their full
+        # records are fetched together the first time one of them is needed
+        page = LazyRecordPage(self.query_records)
+        for dataset_id, dataset in datasets.items():
+            page.add(dataset_id, dataset)
 
     def query_region_async(self, constraints, output_format, get_query_payload, cache=True):
         """
@@ -133,23 +165,167 @@ class CdsClass(BaseQuery):
         print('Final Request payload before requesting to alasky')
         pprint(request_payload)
 
-        if 'moc' in request_payload:
-            filename = request_payload['moc']
-            with open(filename, 'rb') as f:
-                request_payload.pop('moc')
+        return self.__send_request(request_payload, cache)
 
-                response = self._request('GET', url=self.URL, params=request_payload, timeout=self.TIMEOUT, cache=False, files={'moc': f})
+    def __send_request(self, request_payload, cache=True):
+        if 'moc' in request_payload:
+            request_payload = dict(request_payload)
+            moc = request_payload.pop('moc')
+            # the MOC is either the name of a file or its content
+            with (io.BytesIO(moc) if isinstance(moc, bytes) else open(moc, 'rb')) as f:
+                def send():
+                    # the file is read again by each retry
+                    f.seek(0)
+                    return self._request('GET', url=self.URL, params=request_payload, timeout=self.TIMEOUT,
+                                         cache=False, files={'moc': f})
+                response = self.limiter.call(self.URL, send)
         else:
-            response = self._request('GET', url=self.URL, params=request_payload, timeout=self.TIMEOUT, cache=cache)
+            response = self.limiter.call(self.URL, lambda: self._request('GET', url=self.URL, params=request_payload,
+                                                                         timeout=self.TIMEOUT, cache=cache))
 
         return response
 
-    @staticmethod
-    def __parse_to_float(value):
-        try:
-            return float(value)
-        except Exception:
-            return value
+    def query_regions(self, spatial_constraints, output_format=OutputFormat(), properties_constraint=None,
+                      max_workers=8, get_query_payload=False, cache=True):
+        """
+        Run one query per spatial constraint, concurrently
+
+        Parameters
+        ----------
+        spatial_constraints : Cones or [SpatialConstraint or Constraints]
+            The spatial constraints to query. The payloads of a Cones collection
+            (see Cone.from_arrays) are used directly without building any Cone object.
+            Complete Constraints objects can also be given, e.g. to query one
+            properties constraint per dataset
+        output_format : OutputFormat
+            The format of the results, shared by all the queries
+        properties_constraint : PropertyConstraint, optional
+            A properties constraint applied to all the queries
+        max_workers : int
+            The greatest number of queries sent to the MOCServer at the same time. The
+            limiter of the class lowers it when the MOCServer is overloaded.
+        get_query_payload : bool, optional
+            Just return the list of HTTP request parameters.
+        cache : bool
+
+        Returns
+        -------
+        results : list
+            The parsed result of each query, in the order of ``spatial_constraints``
+        """
+        if not isinstance(output_format, OutputFormat):
+            print("Invalid response format. Must be of MOCServerResponseFormat type")
+            raise TypeError
+
+        base_payload = dict(output_format.request_payload)
+        if properties_constraint is not None:
+            base_payload.update(Constraints(pc=properties_constraint).payload)
+
+        if isinstance(spatial_constraints, Cones):
+            spatial_payloads = spatial_constraints.request_payloads()
+        else:
+            spatial_payloads = (sc.payload if isinstance(sc, Constraints) else Constraints(sc=sc).payload
+                                for sc in spatial_constraints)
+
+        request_payloads = []
+        for spatial_payload in spatial_payloads:
+            request_payload = dict(spatial_payload)
+            request_payload.update(base_payload)
+            request_payloads.append(request_payload)
+
+        if get_query_payload:
+            return request_payloads
+
+        def query(request_payload):
+            response = self.__send_request(request_payload, cache)
+            result = CdsClass.__parse_result_region(response, output_format)
+            if output_format.lazy:
+                self.__make_lazy(result)
+            return result
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(query, request_payloads))
+
+    def query_records(self, dataset_ids, field_l=None, batch_size=100, max_workers=4):
+        """
+        Fetch the records of datasets given their IDs
+
+        The IDs are grouped in batches queried with a single ``ID=a || ID=b || ...``
+        properties constraint each. The number of records returned by each query is
+        bounded by the size of its batch with MAXREC.
+
+        Parameters
+        ----------
+        dataset_ids : [str]
+            The IDs of the datasets
+        field_l : [str], optional
+            The properties to retrieve. All the properties are retrieved by default.
+        batch_size : int
+            The number of IDs of each query
+        max_workers : int
+            The number of batches queried at the same time
+
+        Returns
+        -------
+        datasets : {str : Dataset}
+            The Dataset objects indexed by their IDs
+        """
+        output_format = OutputFormat(format=OutputFormat.Type.record, field_l=list(field_l or []),
+                                     max_rec=batch_size)
+        batches = [dataset_ids[i:i + batch_size] for i in range(0, len(dataset_ids), batch_size)]
+        batch_constraints = [Constraints(pc=PropertyConstraint(' || '.join('ID=' + dataset_id for dataset_id in batch)))
+                             for batch in batches]
+
+        datasets = {}
+        for result in self.query_regions(batch_constraints, output_format, max_workers=max_workers):
+            datasets.update(result)
+        return datasets
+
+    def query_moc_from_store(self, constraints, store, output_format=OutputFormat(format=OutputFormat.Type.moc),
+                             n_processes=1):
+        """
+        Compute the union or intersection MOC of the datasets matching some constraints locally
+
+        Only the IDs of the matching datasets are asked to the MOCServer. Their MOCs are
+        read from ``store`` and combined by combine_mocs, which gives the same result as
+        a ``moc`` or ``i_moc`` query at the order of the MOCs of the store. For a lower
+        order, each MOC is degraded before being combined, like the MOCServer does : the
+        intersection of the degraded MOCs is larger than the degraded intersection.
+
+        Parameters
+        ----------
+        constraints : Constraints
+            The constraints the datasets must match
+        store : MocStore
+            The store containing the MOCs of all the matching datasets
+        output_format : OutputFormat
+            A ``moc`` or ``i_moc`` output format. The MOCs are degraded to its order
+            if it is lower than the order of the store.
+        n_processes : int
+            The number of processes combining the MOCs
+
+        Returns
+        -------
+        moc : `~mocpy.MOC`
+        """
+        if output_format.format not in (OutputFormat.Type.moc, OutputFormat.Type.i_moc):
+            print("Only moc and i_moc output formats can be computed from a MocStore")
+            raise ValueError
+
+        dataset_ids = self.query_region(constraints, OutputFormat(format=OutputFormat.Type.id))
+        missing_ids = [dataset_id for dataset_id in dataset_ids if dataset_id not in store]
+        if missing_ids:
+            print("The MOCs of {0} datasets are missing from the store, e.g. {1}".format(len(missing_ids),
+                                                                                         missing_ids[0]))
+            raise ValueError
+
+        order = output_format.request_payload['order']
+        if order == 'max' or order >= store.moc_order:
+            order = None
+
+        operation = 'union' if output_format.format is OutputFormat.Type.moc else 'intersection'
+        ranges = combine_mocs(dataset_ids, operation, n_processes=n_processes, store=store, order=order)
+        return moc_utils.ranges_to_moc(ranges)
 
     @staticmethod
     def orderipix2uniq(n_order, n_pix):
@@ -157,16 +333,13 @@ class CdsClass(BaseQuery):
 
     @staticmethod
     def create_mocpy_object_from_json(json_moc):
-        # TODO : just call the MOC.from_json classmethod to get the corresponding mocpy object
-        uniq_interval = IntervalSet()
-        for n_order, n_pix_l in json_moc.items():
-            n_order = int(n_order)
+        return moc_utils.ranges_to_moc(moc_utils.json_to_ranges(json_moc))
 
-            for n_pix in n_pix_l:
-                uniq_interval.add(__class__.orderipix2uniq(n_order, n_pix))
-
-        moc = MOC.from_uniq_interval_set(uniq_interval)
-        return moc
+    @staticmethod
+    def create_mocpy_object_from_fits(content):
+        # The NUNIQ column is read in place from the response content
+        uniq = moc_utils.uniq_from_fits(content)
+        return moc_utils.ranges_to_moc(moc_utils.uniq_to_ranges(uniq))
 
     @staticmethod
     def __parse_result_region(response, output_format, verbose=False):
@@ -176,13 +349,19 @@ class CdsClass(BaseQuery):
         # try to parse the result into an astropy.Table, else
         # return the raw result with an informative error message.
 
+        if output_format.request_payload['fmt'] == 'fits':
+            # Only MOCs can be serialized in the FITS format
+            return __class__.create_mocpy_object_from_fits(response.content)
+
         r = response.json()
         parsed_r = None
         if output_format.format is OutputFormat.Type.record:
-            parsed_r = [dict([k, CdsClass.__parse_to_float(v)] for k, v in di.items()) for di in r]
-            # Once the properties have been parsed to float we can create the final
+            # The types of the properties are cached across the queries so that
+            # only the values of the numeric properties are converted
+            parsed_r = [CdsClass.property_types.parse(di) for di in r]
+            # Once the properties have been parsed we can create the final
             # dictionary of Dataset objects indexed by their IDs
-            parsed_r = dict([d['ID'], Dataset(**dict([k, CdsClass.__remove_duplicate(d.get(k))] for k in (d.keys() - set('ID'))))] for d in parsed_r)
+            parsed_r = dict([d['ID'], Dataset(**d)] for d in parsed_r)
         elif output_format.format is OutputFormat.Type.number:
             parsed_r = dict(number=int(r['number']))
         elif output_format.format is OutputFormat.Type.moc or\
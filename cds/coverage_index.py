@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+import numpy as np
+
+from astropy_healpix import HEALPix
+
+from . import moc_utils
+
+
+class CoverageIndex(object):
+    """
+    HEALPix inverted index of the MOCs of a MocStore
+
+    Each HEALPix cell of a coarse ``order`` is mapped to the sorted array of the
+    positions (in the store) of the datasets whose MOC touches it. The index also
+    remembers whether the MOC of a dataset covers the cell entirely. A query only
+    looks at the datasets listed in the cells of the region and only reads the
+    full MOCs of the ones lying on the borders of the region.
+
+    The arrays are stored in a CSR layout : the datasets of the cell ``c`` are
+    ``datasets[indptr[c]:indptr[c + 1]]``.
+
+    """
+
+    def __init__(self, store, indptr, datasets, full, order):
+        self.store = store
+        self.order = order
+        self.indptr = indptr
+        self.datasets = datasets
+        self.full = full
+        self.__shift = 2 * (moc_utils.MAX_ORDER - order)
+        self.__hp_deepest = HEALPix(nside=2 ** moc_utils.MAX_ORDER, order='nested')
+
+    @classmethod
+    def build(cls, store, order=5):
+        """
+        Build the index of all the MOCs of a MocStore
+
+        Parameters
+        ----------
+        store : MocStore
+            The store containing the MOCs of the datasets
+        order : int
+            The order of the cells of the index. It must not be deeper than the order
+            of the MOCs of the store.
+
+        Returns
+        -------
+        index : CoverageIndex
+        """
+        if order > store.moc_order:
+            raise ValueError('The order of the index cannot be deeper than the order of the MOCs')
+
+        cells_l = []
+        datasets_l = []
+        full_l = []
+        for i in range(len(store)):
+            ranges = np.asarray(store.ranges_of(i))
+            cells = moc_utils.ranges_to_cells(ranges, order)
+            cells_l.append(cells)
+            datasets_l.append(np.full(len(cells), i, dtype=np.int32))
+            full_l.append(np.isin(cells, moc_utils.ranges_to_full_cells(ranges, order), assume_unique=True))
+
+        cells = np.concatenate(cells_l) if cells_l else np.zeros(0, dtype=np.int64)
+        datasets = np.concatenate(datasets_l) if datasets_l else np.zeros(0, dtype=np.int32)
+        full = np.concatenate(full_l) if full_l else np.zeros(0, dtype=bool)
+
+        sort = np.lexsort((datasets, cells))
+        n_cells = 12 * 4 ** order
+        indptr = np.zeros(n_cells + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(cells, minlength=n_cells))
+
+        return cls(store, indptr, datasets[sort], full[sort], order)
+
+    def save(self, filename):
+        np.savez(filename, indptr=self.indptr, datasets=self.datasets, full=self.full, order=self.order)
+
+    @classmethod
+    def load(cls, filename, store):
+        with np.load(filename) as arrays:
+            return cls(store, arrays['indptr'], arrays['datasets'], arrays['full'], int(arrays['order']))
+
+    def query_position(self, coord):
+        """
+        IDs of the datasets whose MOC contains a sky position
+
+        Parameters
+        ----------
+        coord : astropy.coordinates.SkyCoord
+            A scalar sky position
+
+        Returns
+        -------
+        ids : [str]
+        """
+        return self.query_positions(coord.reshape((1,)))[0]
+
+    def query_positions(self, coords):
+        """
+        IDs of the datasets whose MOC contains each of the sky positions of a SkyCoord array
+
+        The HEALPix cells of all the positions are computed in one vectorized call,
+        which is much faster than calling query_position for each of them.
+
+        Returns
+        -------
+        ids : [[str]]
+            The list of the dataset IDs of each position
+        """
+        coords = coords.icrs
+        ipix_arr = self.__hp_deepest.lonlat_to_healpix(coords.ra, coords.dec)
+        starts = self.indptr[ipix_arr >> self.__shift].tolist()
+        ends = self.indptr[(ipix_arr >> self.__shift) + 1].tolist()
+
+        result = []
+        for ipix, start, end in zip(ipix_arr.tolist(), starts, ends):
+            ids = []
+            for dataset, full in zip(self.datasets[start:end].tolist(), self.full[start:end].tolist()):
+                # Only the datasets partially covering the cell need to be looked at in details
+                if full or moc_utils.ranges_contain(self.store.ranges_of(dataset), ipix):
+                    ids.append(self.store.ids[dataset])
+            result.append(ids)
+
+        return result
+
+    def query_region(self, spatial_constraint):
+        """
+        IDs of the datasets matching a Cone, a Polygon or a Moc spatial constraint
+
+        The region is mapped to HEALPix cells at the order of the MOCs of the store,
+        and the ``intersect`` parameter of the constraint is evaluated the same way
+        as by the MOCServer : 'overlaps' keeps the datasets having at least one cell
+        in common with the region, 'enclosed' the ones lying entirely inside the region
+        and 'covers' the ones covering the whole region.
+
+        Parameters
+        ----------
+        spatial_constraint : Cone, Polygon or Moc
+
+        Returns
+        -------
+        ids : [str]
+        """
+        region = spatial_constraint.healpix_ranges(self.store.moc_order)
+        cells = moc_utils.ranges_to_cells(region, self.order)
+        inner_cells = moc_utils.ranges_to_full_cells(region, self.order)
+
+        starts = self.indptr[cells]
+        rows = moc_utils.expand_ranges(starts, self.indptr[cells + 1])
+        candidates = self.datasets[rows]
+        intersect = spatial_constraint.intersect
+
+        if intersect == 'overlaps':
+            # A dataset fully covering a cell touched by the region overlaps it and so
+            # does a dataset touching a cell entirely inside the region
+            in_inner_cell = np.isin(np.repeat(cells, self.indptr[cells + 1] - starts), inner_cells)
+            accepted = np.unique(candidates[self.full[rows] | in_inner_cell])
+            border = np.setdiff1d(candidates, accepted)
+            matches = [dataset for dataset in border.tolist()
+                       if moc_utils.ranges_overlap(np.asarray(self.store.ranges_of(dataset)), region)]
+            matches = np.union1d(accepted, np.array(matches, dtype=np.int32))
+        elif intersect == 'covers':
+            matches = [dataset for dataset in np.unique(candidates).tolist()
+                       if moc_utils.ranges_include(np.asarray(self.store.ranges_of(dataset)), region)]
+        else:
+            matches = [dataset for dataset in np.unique(candidates).tolist()
+                       if moc_utils.ranges_include(region, np.asarray(self.store.ranges_of(dataset)))]
+
+        return [self.store.ids[dataset] for dataset in np.asarray(matches, dtype=np.int64).tolist()]
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from astropy import units as u
+from astropy_healpix import HEALPix
+from mocpy import MOC
+
+from .moc_store import MocStore
+from . import moc_utils
+
+
+class CoverageMatrix(object):
+    """
+    Sparse boolean matrix telling which datasets cover each source
+
+    The matrix is stored in a CSR layout : the positions (in ``dataset_ids``) of the
+    datasets covering the source ``i`` are ``indices[indptr[i]:indptr[i + 1]]``, sorted.
+
+    """
+
+    def __init__(self, indptr, indices, dataset_ids):
+        self.indptr = indptr
+        self.indices = indices
+        self.dataset_ids = dataset_ids
+
+    @property
+    def shape(self):
+        return len(self.indptr) - 1, len(self.dataset_ids)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, source):
+        """The IDs of the datasets covering a source"""
+        return [self.dataset_ids[i] for i in self.indices[self.indptr[source]:self.indptr[source + 1]].tolist()]
+
+    def counts(self):
+        """The number of datasets covering each source"""
+        return np.diff(self.indptr)
+
+    def sources_of(self, dataset_id):
+        """The indices of the sources covered by a dataset"""
+        rows = np.flatnonzero(self.indices == self.dataset_ids.index(dataset_id))
+        return np.searchsorted(self.indptr, rows, side='right') - 1
+
+    def to_scipy(self):
+        """The matrix as a `scipy.sparse.csr_matrix` of booleans"""
+        from scipy.sparse import csr_matrix
+        return csr_matrix((np.ones(len(self.indices), dtype=bool), self.indices, self.indptr), shape=self.shape)
+
+
+def _concatenate_ranges(mocs):
+    """Put the ranges of the MOCs end to end, the way a MocStore stores them"""
+    ranges_l = [moc_utils.moc_to_ranges(moc) if isinstance(moc, MOC) else np.asarray(moc, dtype=np.int64)
+                for moc in mocs]
+    offsets = np.zeros(len(ranges_l) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ranges) for ranges in ranges_l])
+    ranges = np.concatenate(ranges_l) if ranges_l else moc_utils.empty_ranges()
+    return ranges.reshape(-1, 2), offsets
+
+
+def _match_chunk(ra, dec, ranges, offsets):
+    """
+    The (source, dataset) pairs of a chunk of sources lying in the ranges of the datasets
+
+    The sources are sorted by HEALPix cell once, then the sources lying in each range of
+    every dataset are found by two binary searches, whatever the number of datasets.
+    """
+    if isinstance(ranges, MocStore):
+        ranges, offsets = np.asarray(ranges.ranges), np.asarray(ranges.offsets)
+
+    hp = HEALPix(nside=2 ** moc_utils.MAX_ORDER, order='nested')
+    ipix = hp.lonlat_to_healpix(ra * u.deg, dec * u.deg).astype(np.int64)
+    order = np.argsort(ipix)
+    sorted_ipix = ipix[order]
+
+    first = np.searchsorted(sorted_ipix, ranges[:, 0], side='left')
+    end = np.searchsorted(sorted_ipix, ranges[:, 1], side='left')
+    datasets = np.repeat(np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets)),
+                         end - first)
+    sources = order[moc_utils.expand_ranges(first, end)]
+    return sources, datasets
+
+
+def coverage_matrix(coords, mocs, chunk_size=1000000, n_processes=1):
+    """
+    Compute which datasets cover each source of a list
+
+    The sources are mapped to their HEALPix cells at the deepest order in one
+    vectorized call, then matched against the ranges of all the MOCs at once.
+    The sources are split in chunks of ``chunk_size`` processed in parallel by
+    ``n_processes`` processes.
+
+    Parameters
+    ----------
+    coords : astropy.coordinates.SkyCoord
+        The positions of the sources
+    mocs : MocStore or {str : MOC}
+        The MOCs of the datasets, either a store or a dict of mocpy objects (or
+        arrays of ranges) indexed by dataset IDs
+    chunk_size : int
+        The number of sources processed at once
+    n_processes : int
+        The number of processes. The sources are processed in the current process if 1.
+
+    Returns
+    -------
+    matrix : CoverageMatrix
+        The sources × datasets coverage matrix
+    """
+    if isinstance(mocs, MocStore):
+        dataset_ids = list(mocs.ids)
+        # a store is sent to the other processes by path and memory-mapped again
+        ranges, offsets = (mocs, None) if n_processes > 1 else (np.asarray(mocs.ranges), np.asarray(mocs.offsets))
+    elif isinstance(mocs, dict):
+        dataset_ids = list(mocs.keys())
+        ranges, offsets = _concatenate_ranges(mocs.values())
+    else:
+        print("mocs must be a MocStore or a dict of MOCs indexed by dataset IDs")
+        raise TypeError
+
+    coords = coords.icrs.reshape(-1)
+    ra = coords.ra.deg
+    dec = coords.dec.deg
+    n_sources = len(ra)
+
+    # the HEALPix cells of the sources are computed by the processes too
+    starts = range(0, n_sources, chunk_size)
+    ra_chunks = [ra[start:start + chunk_size] for start in starts]
+    dec_chunks = [dec[start:start + chunk_size] for start in starts]
+    if n_processes > 1:
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            pairs = list(executor.map(_match_chunk, ra_chunks, dec_chunks,
+                                      [ranges] * len(starts), [offsets] * len(starts)))
+    else:
+        pairs = [_match_chunk(ra_chunk, dec_chunk, ranges, offsets)
+                 for ra_chunk, dec_chunk in zip(ra_chunks, dec_chunks)]
+
+    # the pairs are sorted by source, then by dataset, with a single integer key
+    n_datasets = max(len(dataset_ids), 1)
+    keys = np.concatenate([(chunk_sources + start) * n_datasets + chunk_datasets
+                           for start, (chunk_sources, chunk_datasets) in zip(starts, pairs)]
+                          or [np.zeros(0, dtype=np.int64)])
+    keys.sort()
+    sources = keys // n_datasets
+
+    indptr = np.zeros(n_sources + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=n_sources))
+    return CoverageMatrix(indptr, (keys - sources * n_datasets).astype(np.int32), dataset_ids)
@@ -1,40 +1,264 @@
 import pyvo as vo
+import re
+import requests
+import sys
+import threading
+import weakref
+from collections.abc import Mapping
 from enum import Enum
-from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 from random import shuffle
 
-class Dataset:
+import numpy as np
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import votable
+from mocpy import MOC
+
+from .rate_limit import limiter, OVERLOAD_STATUS_CODES
+from .binary_votable import BINARY2_MIME_TYPE, decode_votable
+from .spatial_constraints import _cone_ranges
+from . import moc_utils
+
+
+class _KeyTable(object):
+    """
+    Property names of datasets, shared by all the datasets having the same properties
+
+    The names are interned so that a name is stored once in memory, whatever
+    the number of datasets having it.
+    """
+    __slots__ = ('keys', 'positions', '__weakref__')
+
+    def __init__(self, keys):
+        self.keys = tuple(sys.intern(key) for key in keys)
+        self.positions = dict((key, i) for i, key in enumerate(self.keys))
+
+
+class PropertiesView(Mapping):
+    """
+    Read-only mapping view on the properties of a dataset
+
+    The view of a lazy dataset (see LazyRecordPage) fetches its full record
+    when a property that has not been loaded yet is read.
+    """
+    __slots__ = ('_table', '_values', '_dataset')
+
+    def __init__(self, table, values, dataset=None):
+        self._table = table
+        self._values = values
+        self._dataset = dataset
+
+    def _hydrate(self):
+        if self._dataset is not None:
+            self._table, self._values = self._dataset._hydrate()
+            self._dataset = None
+
+    def __getitem__(self, key):
+        position = self._table.positions.get(key)
+        if position is None and self._dataset is not None:
+            self._hydrate()
+            position = self._table.positions.get(key)
+        if position is None:
+            raise KeyError(key)
+        return self._values[position]
+
+    def __contains__(self, key):
+        if key not in self._table.positions:
+            self._hydrate()
+        return key in self._table.positions
+
+    def __iter__(self):
+        self._hydrate()
+        return iter(self._table.keys)
+
+    def __len__(self):
+        self._hydrate()
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class LazyRecordPage(object):
+    """
+    Datasets of a lazy query result whose full records have not been fetched yet
+
+    The first time a dataset of the page needs a property it does not have, the
+    full records of all the pending datasets of the page are fetched at once and
+    the datasets keep them afterwards.
+
+    Parameters
+    ----------
+    fetch : callable
+        Called with a list of dataset IDs, returns the full Dataset objects indexed by their IDs
+    """
+
+    def __init__(self, fetch):
+        self.__fetch = fetch
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def add(self, dataset_id, dataset):
+        self.__pending[dataset_id] = dataset
+        dataset._set_page(self)
+
+    def load(self):
+        # The lock is held during the fetch so that a thread reading a property
+        # waits for a fetch started by another thread
+        with self.__lock:
+            if not self.__pending:
+                return
+            datasets = self.__fetch(list(self.__pending.keys()))
+            for dataset_id, dataset in self.__pending.items():
+                if dataset_id in datasets:
+                    dataset._set_properties(datasets[dataset_id].properties)
+                else:
+                    dataset._set_page(None)
+            self.__pending = {}
+
+
+def _to_degrees(value):
+    if isinstance(value, u.Quantity):
+        return value.to_value(u.deg)
+    return np.asarray(value, dtype=np.float64)
+
+
+def _search_cone(kwargs, size_param):
+    """
+    The cone (ra, dec, radius in degrees) enclosing the region of a positional search,
+    None if the search has no region
+    """
+    pos = kwargs.get('pos')
+    size = kwargs.get(size_param)
+    if pos is None or size is None:
+        return None
+
+    if isinstance(pos, SkyCoord):
+        pos = pos.icrs
+        ra, dec = pos.ra.deg, pos.dec.deg
+    else:
+        ra, dec = (float(_to_degrees(v)) for v in pos)
+
+    size = _to_degrees(size)
+    if size_param == 'radius':
+        radius = float(size)
+    elif size_param == 'diameter':
+        radius = float(size) / 2
+    else:
+        # the circle circumscribing the (width, height) rectangle of a SIA search
+        width, height = np.broadcast_to(size, (2,))
+        radius = float(np.hypot(width, height)) / 2
+    return ra, dec, radius
+
+
+class Dataset(object):
+    """
+    Dataset record returned by the MOCServer
+
+    Datasets hold their property values in a tuple and share the table of their
+    property names with the other datasets having the same properties. The
+    properties are read through a read-only mapping view and the pyvo services
+    are only created when a search is performed.
+    """
+    __slots__ = ('__keys', '__values', '__services', '__page', '__coverage')
 
     # The timeout for a tap service before the request is aborted
     tap_service_timeout = 10
 
+    # Bounds the rate and the concurrency of the searches, shared with the MOCServer queries
+    limiter = limiter
+
+    # A SearchCache keeping the results of the searches already performed. The
+    # searches are not cached by default
+    search_cache = None
+
+    # The key tables currently in use, indexed by their property names
+    __key_tables = weakref.WeakValueDictionary()
+
     class ServiceType(Enum):
         cs = 1,
         tap = 2,
         ssa = 4,
         sia = 5
 
+    __service_classes = {
+        ServiceType.tap: vo.dal.TAPService,
+        ServiceType.cs: vo.dal.SCSService,
+        ServiceType.ssa: vo.dal.SSAService,
+        ServiceType.sia: vo.dal.SIAService,
+    }
+
+    # The parameter giving the size of the searched region, for each type of positional service
+    search_size_params = {
+        ServiceType.cs: 'radius',
+        ServiceType.sia: 'size',
+        ServiceType.ssa: 'diameter',
+    }
+
+    # A MocStore giving the coverage of the datasets. The coverage of the datasets
+    # missing from the store is fetched from their moc_access_url property
+    coverage_store = None
+    # The HEALPix order at which the regions of the searches are compared to the coverages
+    coverage_order = 10
+
+    # The types of services asked for BINARY2 VOTables through the RESPONSEFORMAT parameter
+    # by the searches returning astropy Tables
+    binary2_service_types = (ServiceType.tap,)
+    # The URLs of the services that failed to answer in BINARY2
+    __text_only_urls = set()
+    # Matches the messages of the errors telling that the BINARY2 serialization is not supported
+    __unsupported_format_regex = re.compile(
+        r'RESPONSEFORMAT|BINARY2|(unsupported|unknown|invalid) (output |response )?format', re.IGNORECASE)
+
     def __init__(self, **kwargs):
         assert len(kwargs.keys()) >= 1
-        self.__properties = kwargs
-        self.__services = {}
+        self.__page = None
+        self.__coverage = None
+        self._set_properties(kwargs)
 
+    def _set_properties(self, properties):
+        keys = tuple(properties.keys())
+        key_table = Dataset.__key_tables.get(keys)
+        if key_table is None:
+            key_table = _KeyTable(keys)
+            Dataset.__key_tables[keys] = key_table
+
+        self.__keys = key_table
+        self.__values = tuple(properties.values())
+        self.__page = None
         # These services are available from the properties of
-        # a dataset
-        self.__init_service(__class__.ServiceType.tap, vo.dal.TAPService)
-        self.__init_service(__class__.ServiceType.cs, vo.dal.SCSService)
-        self.__init_service(__class__.ServiceType.ssa, vo.dal.SSAService)
-        self.__init_service(__class__.ServiceType.sia, vo.dal.SIAService)
+        # a dataset. They are created on the first search
+        self.__services = None
+
+    def _set_page(self, page):
+        self.__page = page
+
+    def _hydrate(self):
+        """Fetch the full record of a lazy dataset, along with the ones of its page"""
+        if self.__page is not None:
+            self.__page.load()
+        return self.__keys, self.__values
+
+    def __init_services(self):
+        self.__services = {}
+        for service_type, service_class in Dataset.__service_classes.items():
+            self.__init_service(service_type, service_class)
 
     def __init_service(self, service_type, service_class):
         name_srv_property = service_type.name + '_service_url'
+        properties = self.properties
 
         id_mirror_server = 1
         while True:
-            if name_srv_property not in self.__properties.keys():
+            if name_srv_property not in properties:
                 break
 
-            new_service = service_class(self.__properties[name_srv_property])
+            new_service = service_class(properties[name_srv_property])
 
             if service_type not in self.__services.keys():
                 self.__services[service_type] = [new_service]
@@ -53,16 +277,80 @@ class Dataset:
         if service_type in self.__services.keys():
             shuffle(self.__services[service_type])
 
-
     @property
     def properties(self):
-        return copy(self.__properties)
+        return PropertiesView(self.__keys, self.__values, self if self.__page is not None else None)
 
     @property
     def services(self):
-        return [service_type.name for service_type in self.__services.keys()]
+        self._hydrate()
+        return [service_type.name for service_type in Dataset.__service_classes.keys()
+                if service_type.name + '_service_url' in self.__keys.positions]
+
+    @property
+    def coverage(self):
+        """
+        The ranges of the MOC of the dataset, None if it is not available
+
+        The MOC is read from ``Dataset.coverage_store`` or else fetched once from the
+        ``moc_access_url`` property of the dataset.
+        """
+        if self.__coverage is None:
+            self.__coverage = self.__load_coverage()
+        return self.__coverage if self.__coverage is not False else None
+
+    def set_coverage(self, moc):
+        """Give the MOC (a mocpy object or an array of ranges) of the dataset"""
+        if isinstance(moc, MOC):
+            self.__coverage = moc_utils.moc_to_ranges(moc)
+        else:
+            self.__coverage = np.asarray(moc, dtype=np.int64).reshape(-1, 2)
+
+    def __load_coverage(self):
+        # False tells that the coverage is unavailable so that it is not fetched again
+        properties = self.properties
+        dataset_id = properties.get('ID')
+        if self.coverage_store is not None and dataset_id in self.coverage_store:
+            return np.asarray(self.coverage_store.ranges_of(dataset_id))
+
+        url = properties.get('moc_access_url')
+        if not url:
+            return False
+
+        def fetch():
+            response = requests.get(url, timeout=self.tap_service_timeout)
+            response.raise_for_status()
+            return response.content
+
+        try:
+            content = self.limiter.call(url, fetch)
+            return moc_utils.uniq_to_ranges(moc_utils.uniq_from_fits(content))
+        except (requests.exceptions.RequestException, KeyError, ValueError):
+            return False
+
+    def may_match(self, service_type, **kwargs):
+        """
+        Tell whether a positional search may return records, from the coverage of the dataset
+
+        The region of the search is compared to the MOC of the dataset at the order
+        ``Dataset.coverage_order``, so that a search is only ruled out when its region
+        lies entirely outside of the coverage. The searches without a region (TAP) and
+        the datasets whose coverage is unavailable always may match.
+        """
+        size_param = self.search_size_params.get(service_type)
+        cone = _search_cone(kwargs, size_param) if size_param else None
+        if cone is None:
+            return True
 
-    def search(self, service_type, **kwargs):
+        coverage = self.coverage
+        if coverage is None:
+            return True
+
+        ra, dec, radius = np.radians(cone)
+        region = _cone_ranges(ra, dec, radius, self.coverage_order)
+        return moc_utils.ranges_overlap(coverage, region)
+
+    def search(self, service_type, as_table=False, prune=False, **kwargs):
         """
         Definition of the search function allowing the user to perform queries on the dataset.
 
@@ -84,33 +372,139 @@ class Dataset:
 
             For more explanation about what params to use with a service, see the pyvo
             doc available at : http://pyvo.readthedocs.io/en/latest/dal/index.html
+        :param as_table:
+            Return an astropy Table instead of a votable. The BINARY2 responses are then
+            decoded directly into numpy arrays.
+        :param prune:
+            Do not query the service when the region of the search lies outside of the
+            coverage of the dataset (see `may_match`). None is then returned.
         :return:
             a votable containing all the sources from the dataset that match the query
 
+        When ``Dataset.search_cache`` is set to a SearchCache, e.g. ``SearchCache()`` writing
+        to the astropy cache directory, the results are cached on disk and a search already
+        performed on the same version of the dataset is read from the cache. Setting it back
+        to None disables the cache.
+
+        With ``as_table=True``, the services whose type is in ``Dataset.binary2_service_types``
+        are asked for a BINARY2 VOTable, which is decoded much faster than the default
+        TABLEDATA one. The votables are always requested in TABLEDATA. A service answering
+        that it does not support BINARY2 is queried again in TABLEDATA, and only in
+        TABLEDATA once it has answered.
+
         """
         if not isinstance(service_type, Dataset.ServiceType):
             print("Service {0} not found".format(service_type))
             raise ValueError
 
+        if self.__services is None:
+            self._hydrate()
+            self.__init_services()
+
         if service_type not in self.__services.keys():
             print('The service {0:s} is not available for this dataset'.format(service_type.name))
             print('Available services are the following :\n{0}'.format(self.services))
             raise KeyError
 
+        if prune and not self.may_match(service_type, **kwargs):
+            return None
+
+        if self.search_cache is not None:
+            result = self.search_cache.get(self, service_type, kwargs)
+            if result is not None:
+                return result.get_first_table().to_table() if as_table else result
+
         services_l = self.__services[service_type]
 
         """ Mirrors services are queried in a random way (services_l shuffled) until 
         DALErrors are not raised and we get a votable"""
         result = None
         index_service = 0
-        while not result:
+        while result is None:
             try:
-                result = services_l[index_service].search(**kwargs).votable
+                service = services_l[index_service]
+                result = self.limiter.call(service.baseurl,
+                                           lambda: self.__search_service(service, service_type, as_table, kwargs))
             except (vo.dal.DALQueryError, vo.dal.DALServiceError) as dal_error:
                 if index_service >= len(services_l) - 1:
                     raise dal_error
 
             index_service += 1
 
+        if self.search_cache is not None:
+            self.search_cache.put(self, service_type, kwargs, votable.from_table(result) if as_table else result)
+
+        return result
+
+    @staticmethod
+    def search_many(datasets, service_type, max_workers=8, prune=True, as_table=False, **kwargs):
+        """
+        Perform the same search on several datasets concurrently
+
+        Parameters
+        ----------
+        datasets : {str : Dataset} or [Dataset]
+            The datasets to query, e.g. the result of a MOCServer query
+        service_type : Dataset.ServiceType
+            The type of service to query
+        max_workers : int
+            The number of searches sent at once. The rate of the requests is bounded
+            by ``Dataset.limiter`` anyway.
+        prune : bool
+            Skip the datasets whose coverage does not meet the region of the search
+        as_table : bool
+            Return astropy Tables instead of votables
+        **kwargs
+            The search parameters given to `search`
+
+        Returns
+        -------
+        results : {str : votable or None}
+            The results indexed by dataset ID. The skipped datasets have a None result.
+        """
+        if isinstance(datasets, Mapping):
+            datasets = list(datasets.values())
+        datasets = [dataset for dataset in datasets if service_type.name in dataset.services]
+
+        def search(dataset):
+            # the coverage is checked by the worker, as it may have to be downloaded
+            if prune and not dataset.may_match(service_type, **kwargs):
+                return None
+            return dataset.search(service_type, as_table=as_table, **kwargs)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip((dataset.properties['ID'] for dataset in datasets), executor.map(search, datasets)))
+
+    def __search_service(self, service, service_type, as_table, kwargs):
+        # astropy parses BINARY2 more slowly than TABLEDATA, so that BINARY2 is only worth
+        # asking for when the table is decoded directly into numpy arrays
+        binary2 = as_table and service_type in self.binary2_service_types \
+            and service.baseurl not in Dataset.__text_only_urls \
+            and not any(key.upper() == 'RESPONSEFORMAT' for key in kwargs)
+        if not binary2:
+            return Dataset.__query_service(service, as_table, kwargs)
+
+        try:
+            return Dataset.__query_service(service, as_table, dict(kwargs, RESPONSEFORMAT=BINARY2_MIME_TYPE))
+        except (vo.dal.DALQueryError, vo.dal.DALServiceError) as dal_error:
+            # an overloaded service is retried by the limiter as is, and the other errors
+            # (e.g. an invalid query) are not caused by the BINARY2 serialization
+            if getattr(dal_error, 'code', None) in OVERLOAD_STATUS_CODES \
+                    or not Dataset.__unsupported_format_regex.search(str(dal_error)):
+                raise
+
+        # the service does not support BINARY2. It is queried in TABLEDATA from now on
+        # once it has answered in TABLEDATA
+        result = Dataset.__query_service(service, as_table, kwargs)
+        Dataset.__text_only_urls.add(service.baseurl)
         return result
 
+    @staticmethod
+    def __query_service(service, as_table, params):
+        if as_table:
+            stream = service.create_query(**params).execute_stream()
+            try:
+                return decode_votable(stream.read())
+            finally:
+                stream.close()
+        return service.search(**params).votable
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+import json
+import os
+from collections import namedtuple
+
+from .constraints import Constraints
+from .property_constraint import PropertyConstraint
+from .output_format import OutputFormat
+from .dataset import Dataset
+
+SyncReport = namedtuple('SyncReport', ['added', 'updated', 'deleted'])
+
+
+class CatalogueMirror(object):
+    """
+    Local copy of the records of the MOCServer datasets
+
+    The records are stored in a json snapshot along with a high-water mark : the
+    greatest value of a date property (``moc_release_date`` by default) among the
+    records of the snapshot. A sync only downloads the records whose date is after
+    the high-water mark, plus the records that are missing from the snapshot.
+    Datasets removed from the MOCServer are found by comparing the snapshot with
+    the list of the IDs of the MOCServer, which is cheap to get.
+
+    """
+
+    SNAPSHOT_FILENAME = 'records.json'
+
+    def __init__(self, path, date_property='moc_release_date'):
+        self.path = path
+        self.date_property = date_property
+        self.high_water_mark = None
+        self.records = {}
+
+        filename = os.path.join(path, CatalogueMirror.SNAPSHOT_FILENAME)
+        if os.path.exists(filename):
+            with open(filename, 'r') as f_in:
+                snapshot = json.load(f_in)
+            self.high_water_mark = snapshot['high_water_mark']
+            self.records = snapshot['records']
+
+    def __len__(self):
+        return len(self.records)
+
+    def datasets(self):
+        """The Dataset objects of the snapshot indexed by their IDs"""
+        return dict((dataset_id, Dataset(**record)) for dataset_id, record in self.records.items())
+
+    def sync(self, cds=None):
+        """
+        Update the snapshot with the changes made on the MOCServer since the last sync
+
+        The first sync downloads all the records.
+
+        Parameters
+        ----------
+        cds : CdsClass, optional
+            The client used to query the MOCServer
+
+        Returns
+        -------
+        report : SyncReport
+            The IDs of the datasets added, updated and deleted by the sync
+        """
+        if cds is None:
+            from .core import cds
+
+        all_ids = cds.query_region(Constraints(pc=PropertyConstraint('ID=*')),
+                                   OutputFormat(format=OutputFormat.Type.id))
+
+        if self.high_water_mark is None:
+            changed = cds.query_region(Constraints(pc=PropertyConstraint('ID=*')),
+                                       OutputFormat(format=OutputFormat.Type.record))
+        else:
+            expr = '{0}>{1}'.format(self.date_property, self.high_water_mark)
+            changed = cds.query_region(Constraints(pc=PropertyConstraint(expr)),
+                                       OutputFormat(format=OutputFormat.Type.record))
+
+            # records lacking the date property are never returned by the query above
+            missing_ids = [dataset_id for dataset_id in all_ids
+                           if dataset_id not in self.records and dataset_id not in changed]
+            if missing_ids:
+                changed.update(cds.query_records(missing_ids))
+
+        added = []
+        updated = []
+        for dataset_id, dataset in changed.items():
+            if dataset_id in self.records:
+                updated.append(dataset_id)
+            else:
+                added.append(dataset_id)
+            self.records[dataset_id] = dict(dataset.properties)
+
+        current_ids = set(all_ids)
+        deleted = [dataset_id for dataset_id in self.records if dataset_id not in current_ids]
+        for dataset_id in deleted:
+            del self.records[dataset_id]
+
+        dates = [str(record[self.date_property]) for record in self.records.values()
+                 if self.date_property in record]
+        if dates:
+            # the dates are ISO 8601 strings so they are ordered as strings
+            self.high_water_mark = max(dates)
+
+        self.save()
+        return SyncReport(sorted(added), sorted(updated), sorted(deleted))
+
+    def save(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        # The snapshot is written to a temporary file first so that an interrupted
+        # sync never leaves a truncated snapshot behind
+        filename = os.path.join(self.path, CatalogueMirror.SNAPSHOT_FILENAME)
+        with open(filename + '.tmp', 'w') as f_out:
+            json.dump({'high_water_mark': self.high_water_mark, 'records': self.records}, f_out)
+        os.replace(filename + '.tmp', filename)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+import threading
+from collections import OrderedDict
+
+from . import moc_utils
+
+
+class MocPyramidCache(object):
+    """
+    Cache of the union MOCs returned by the MOCServer, one pyramid of orders per query
+
+    The MOCs are indexed by the parameters of their query, except the order and the
+    serialization format. Each entry keeps the deepest MOC fetched for the query and
+    the coarser MOCs derived from it. A MOC asked at an order coarser than the deepest
+    one fetched is obtained by degrading it locally, which gives the same cells as the
+    MOCServer : the union of the MOCs of the datasets degraded to an order is the
+    degradation of their union. Only a deeper order requires a new request.
+
+    Intersection MOCs (``i_moc``) are not cached : the intersection of degraded MOCs
+    is generally larger than the degradation of their intersection.
+
+    The least recently used pyramids are evicted once the ranges of all the
+    pyramids exceed ``max_ranges``.
+
+    Parameters
+    ----------
+    max_ranges : int
+        The greatest total number of ranges kept in the cache (16 bytes each)
+
+    """
+
+    def __init__(self, max_ranges=2000000):
+        self.max_ranges = max_ranges
+        self.__pyramids = OrderedDict()
+        self.__n_ranges = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__pyramids)
+
+    @property
+    def n_ranges(self):
+        return self.__n_ranges
+
+    def clear(self):
+        with self.__lock:
+            self.__pyramids.clear()
+            self.__n_ranges = 0
+
+    @staticmethod
+    def cacheable(request_payload):
+        # the uploaded MOC files are only known by their names
+        return request_payload.get('get') == 'moc' and 'moc' not in request_payload
+
+    @staticmethod
+    def __key(request_payload):
+        return tuple(sorted((key, str(value)) for key, value in request_payload.items()
+                            if key not in ('order', 'fmt')))
+
+    @staticmethod
+    def __order(request_payload):
+        order = request_payload.get('order', 'max')
+        return moc_utils.MAX_ORDER + 1 if order == 'max' else int(order)
+
+    def get(self, request_payload):
+        """
+        The ranges of the MOC answering a query, None if it cannot be derived from the cache
+        """
+        order = MocPyramidCache.__order(request_payload)
+        key = MocPyramidCache.__key(request_payload)
+        with self.__lock:
+            pyramid = self.__pyramids.get(key)
+            if pyramid is None:
+                return None
+
+            deepest = max(pyramid.keys())
+            if order > deepest:
+                return None
+
+            self.__pyramids.move_to_end(key)
+            if order not in pyramid:
+                pyramid[order] = moc_utils.degrade_ranges(pyramid[deepest], order)
+                self.__n_ranges += len(pyramid[order])
+                self.__evict()
+            return pyramid[order]
+
+    def put(self, request_payload, ranges):
+        """Cache the ranges of the MOC answering a query"""
+        order = MocPyramidCache.__order(request_payload)
+        key = MocPyramidCache.__key(request_payload)
+        with self.__lock:
+            pyramid = self.__pyramids.pop(key, {})
+            if pyramid and order < max(pyramid.keys()):
+                # a deeper MOC is already cached
+                self.__pyramids[key] = pyramid
+                return
+
+            # the coarser levels are derived again from the new deepest MOC
+            self.__n_ranges -= sum(len(level) for level in pyramid.values())
+            self.__pyramids[key] = {order: ranges}
+            self.__n_ranges += len(ranges)
+            self.__evict()
+
+    def __evict(self):
+        # the most recently used pyramid is kept even if it exceeds the limit alone
+        while self.__n_ranges > self.max_ranges and len(self.__pyramids) > 1:
+            _, pyramid = self.__pyramids.popitem(last=False)
+            self.__n_ranges -= sum(len(level) for level in pyramid.values())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""
+Union and intersection of the MOCs of many datasets, computed locally
+
+These functions give the same MOCs as the ``moc`` and ``i_moc`` outputs of the
+MOCServer from MOCs that are already available locally, e.g. in a MocStore.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mocpy import MOC
+
+from . import moc_utils
+
+OPERATIONS = {
+    'union': moc_utils.union_ranges,
+    'intersection': moc_utils.intersection_ranges,
+}
+
+
+def _as_ranges(moc, store=None):
+    if store is not None:
+        return np.asarray(store.ranges_of(moc))
+    if isinstance(moc, MOC):
+        return moc_utils.moc_to_ranges(moc)
+    return np.asarray(moc, dtype=np.int64).reshape(-1, 2)
+
+
+def _tree_reduce(ranges_l, operation):
+    # The MOCs are combined two by two so that each level handles MOCs of similar sizes
+    combine = OPERATIONS[operation]
+    while len(ranges_l) > 1:
+        reduced = [combine(ranges_l[i], ranges_l[i + 1]) for i in range(0, len(ranges_l) - 1, 2)]
+        if len(ranges_l) % 2:
+            reduced.append(ranges_l[-1])
+        ranges_l = reduced
+    return ranges_l[0] if ranges_l else moc_utils.empty_ranges()
+
+
+def _reduce_chunk(mocs, operation, store=None, order=None):
+    ranges_l = [_as_ranges(moc, store) for moc in mocs]
+    if order is not None:
+        ranges_l = [moc_utils.degrade_ranges(ranges, order) for ranges in ranges_l]
+    return _tree_reduce(ranges_l, operation)
+
+
+def combine_mocs(mocs, operation='union', n_processes=1, store=None, order=None):
+    """
+    Union or intersection of MOCs by a tree reduction
+
+    The MOCs are split in ``n_processes`` chunks reduced in parallel, the results of
+    the chunks being reduced in the current process.
+
+    Parameters
+    ----------
+    mocs : [MOC or `~numpy.ndarray` or str]
+        The MOCs as mocpy objects or arrays of ranges, or the IDs of the datasets
+        when ``store`` is given
+    operation : str
+        'union' or 'intersection'
+    n_processes : int
+        The number of processes. The reduction is done in the current process if 1.
+    store : MocStore, optional
+        The store of the MOCs of the datasets. It is sent to the other processes by
+        path instead of sending the MOCs.
+    order : int, optional
+        The order to which each MOC is degraded before being combined. The
+        intersection of the degraded MOCs is larger than the degraded intersection
+        of the MOCs, e.g. for two MOCs covering distinct parts of the same cell.
+
+    Returns
+    -------
+    ranges : `~numpy.ndarray`
+        The merged ranges of the result
+    """
+    if operation not in OPERATIONS:
+        print("operation must have a value in ('union', 'intersection')")
+        raise ValueError
+
+    mocs = list(mocs)
+    if n_processes <= 1 or len(mocs) < 2 * n_processes:
+        return _reduce_chunk(mocs, operation, store, order)
+
+    chunk_size = -(-len(mocs) // n_processes)
+    chunks = [mocs[i:i + chunk_size] for i in range(0, len(mocs), chunk_size)]
+    if store is None:
+        # the mocpy objects are converted before being sent to the processes
+        chunks = [[_as_ranges(moc) for moc in chunk] for chunk in chunks]
+
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        partials = list(executor.map(_reduce_chunk, chunks, [operation] * len(chunks), [store] * len(chunks),
+                                     [order] * len(chunks)))
+    return _tree_reduce(partials, operation)
+
+
+class IncrementalCoverage(object):
+    """
+    Union and intersection of a set of MOCs updated when MOCs are added or removed
+
+    The sky is split in segments counting the number of MOCs covering them : the
+    union is made of the segments covered at least once and the intersection of
+    the ones covered by all the MOCs. Adding or removing a MOC only updates the
+    counts of the segments it covers instead of combining all the MOCs again.
+
+    Parameters
+    ----------
+    store : MocStore, optional
+        The store from which the MOCs of the datasets added by ID are read
+
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self.__ranges = {}
+        self.__edges = np.zeros(0, dtype=np.int64)
+        self.__counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.__ranges)
+
+    def __contains__(self, dataset_id):
+        return dataset_id in self.__ranges
+
+    @property
+    def dataset_ids(self):
+        return list(self.__ranges.keys())
+
+    def add(self, dataset_id, moc=None):
+        """
+        Add the MOC of a dataset
+
+        ``moc`` (a mocpy object or an array of ranges) is read from the store if not given.
+        """
+        if dataset_id in self.__ranges:
+            return
+        ranges = _as_ranges(dataset_id, self.store) if moc is None else _as_ranges(moc)
+        self.__ranges[dataset_id] = ranges
+        self.__apply(ranges, 1)
+
+    def remove(self, dataset_id):
+        """Remove the MOC of a dataset"""
+        self.__apply(self.__ranges.pop(dataset_id), -1)
+
+    def __apply(self, ranges, increment):
+        # split the segments at the bounds of the ranges, then update the counts of the ones they cover
+        edges = np.union1d(self.__edges, ranges.ravel())
+        i = np.searchsorted(self.__edges, edges, side='right') - 1
+        counts = self.__counts[np.maximum(i, 0)] if len(self.__counts) else np.zeros(len(edges), dtype=np.int64)
+        counts = np.where(i >= 0, counts, 0) + increment * moc_utils.ranges_contain(ranges, edges)
+
+        # the edges between two segments having the same count are dropped
+        keep = np.ones(len(edges), dtype=bool)
+        keep[1:] = counts[1:] != counts[:-1]
+        if len(edges):
+            keep[0] = counts[0] != 0
+        self.__edges = edges[keep]
+        self.__counts = counts[keep]
+
+    def update(self, dataset_ids):
+        """
+        Make the set of MOCs the MOCs of ``dataset_ids``, adding and removing the ones that changed
+
+        Returns
+        -------
+        added, removed : [str], [str]
+        """
+        dataset_ids = list(dataset_ids)
+        new_ids = set(dataset_ids)
+        removed = [dataset_id for dataset_id in self.__ranges if dataset_id not in new_ids]
+        added = [dataset_id for dataset_id in dataset_ids if dataset_id not in self.__ranges]
+        for dataset_id in removed:
+            self.remove(dataset_id)
+        for dataset_id in added:
+            self.add(dataset_id)
+        return added, removed
+
+    def union(self):
+        """The ranges covered by at least one MOC"""
+        return moc_utils.segments_to_ranges(self.__edges, self.__counts > 0)
+
+    def intersection(self):
+        """The ranges covered by all the MOCs"""
+        if not self.__ranges:
+            return moc_utils.empty_ranges()
+        return moc_utils.segments_to_ranges(self.__edges, self.__counts == len(self.__ranges))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+import json
+import os
+
+import numpy as np
+
+from .constraints import Constraints
+from .property_constraint import PropertyConstraint
+from .output_format import OutputFormat
+from . import moc_utils
+
+
+class MocStore(object):
+    """
+    Read-only on-disk store of the MOCs of many datasets
+
+    The MOCs are stored in a directory containing :
+
+    - ``ranges.bin`` : the concatenated ranges (at the deepest HEALPix order) of all the MOCs,
+      as raw int64 values
+    - ``offsets.npy`` : the index of the first range of each dataset in ``ranges.bin``
+    - ``index.json`` : the IDs of the datasets and the order at which their MOCs have been fetched
+
+    ``ranges.bin`` and ``offsets.npy`` are opened with `numpy.memmap` so that loading
+    the ranges of a dataset does not read anything else from the disk, and so that
+    several processes opening the same store share its pages instead of copying them.
+
+    """
+
+    RANGES_FILENAME = 'ranges.bin'
+    OFFSETS_FILENAME = 'offsets.npy'
+    INDEX_FILENAME = 'index.json'
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MocStore.INDEX_FILENAME), 'r') as f_in:
+            index = json.load(f_in)
+
+        self.moc_order = index['moc_order']
+        self.ids = index['ids']
+        self.__positions = dict((dataset_id, i) for i, dataset_id in enumerate(self.ids))
+
+        self.offsets = np.load(os.path.join(path, MocStore.OFFSETS_FILENAME), mmap_mode='r')
+        if self.offsets[-1] > 0:
+            self.ranges = np.memmap(os.path.join(path, MocStore.RANGES_FILENAME),
+                                    dtype=np.int64, mode='r').reshape(-1, 2)
+        else:
+            self.ranges = moc_utils.empty_ranges()
+
+    # The memory maps are opened again when the store is sent to another process
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, dataset_id):
+        return dataset_id in self.__positions
+
+    def position(self, dataset_id):
+        """Index of a dataset in the store"""
+        return self.__positions[dataset_id]
+
+    def ranges_of(self, dataset_id):
+        """
+        The ranges of the MOC of a dataset
+
+        Returns a read-only view on the memory-mapped ranges of the store.
+        ``dataset_id`` can also be the position of the dataset in the store.
+        """
+        i = dataset_id if isinstance(dataset_id, (int, np.integer)) else self.__positions[dataset_id]
+        return self.ranges[self.offsets[i]:self.offsets[i + 1]]
+
+    def moc(self, dataset_id):
+        """The MOC of a dataset as a mocpy object"""
+        return moc_utils.ranges_to_moc(np.asarray(self.ranges_of(dataset_id)))
+
+    @classmethod
+    def write(cls, path, mocs, moc_order):
+        """
+        Create a store from an iterable of (dataset ID, MOC) pairs
+
+        The MOCs can be mocpy objects or arrays of ranges. They are written one
+        after the other, so ``mocs`` can be a generator that is never entirely
+        held in memory.
+
+        Returns
+        -------
+        store : MocStore
+            the newly created store
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        ids = []
+        offsets = [0]
+        with open(os.path.join(path, MocStore.RANGES_FILENAME), 'wb') as f_out:
+            for dataset_id, moc in mocs:
+                ranges = moc if isinstance(moc, np.ndarray) else moc_utils.moc_to_ranges(moc)
+                ranges = np.ascontiguousarray(ranges, dtype=np.int64)
+                f_out.write(ranges.tobytes())
+
+                ids.append(dataset_id)
+                offsets.append(offsets[-1] + len(ranges))
+
+        np.save(os.path.join(path, MocStore.OFFSETS_FILENAME), np.array(offsets, dtype=np.int64))
+        with open(os.path.join(path, MocStore.INDEX_FILENAME), 'w') as f_out:
+            json.dump({'moc_order': moc_order, 'ids': ids}, f_out)
+
+        return cls(path)
+
+
+def harvest_mocs(path, moc_order, dataset_ids=None, constraints=None, max_workers=8, cds=None):
+    """
+    Fetch the MOC of many datasets concurrently and write them in a MocStore
+
+    Parameters
+    ----------
+    path : str
+        The directory of the store to create
+    moc_order : int
+        The order at which the MOCs are requested to the MOCServer
+    dataset_ids : [str], optional
+        The IDs of the datasets whose MOCs are harvested. By default, the IDs of
+        all the datasets matching ``constraints`` are used.
+    constraints : Constraints, optional
+        Used to list the datasets if ``dataset_ids`` is not given. By default, all
+        the datasets of the MOCServer are harvested.
+    max_workers : int
+        The number of MOCs fetched at the same time
+    cds : CdsClass, optional
+        The client used to query the MOCServer
+
+    Returns
+    -------
+    store : MocStore
+    """
+    if cds is None:
+        from .core import cds
+
+    if dataset_ids is None:
+        if constraints is None:
+            constraints = Constraints(pc=PropertyConstraint('ID=*'))
+        dataset_ids = cds.query_region(constraints, OutputFormat(format=OutputFormat.Type.id))
+
+    output_format = OutputFormat(format=OutputFormat.Type.moc, moc_order=moc_order, moc_serialization='fits')
+
+    def fetch_mocs():
+        # The MOCs are fetched by chunks so that only a few of them are held in memory
+        # before being written to the store
+        chunk_size = 16 * max_workers
+        for start in range(0, len(dataset_ids), chunk_size):
+            chunk_ids = dataset_ids[start:start + chunk_size]
+            moc_constraints = [Constraints(pc=PropertyConstraint('ID={0}'.format(dataset_id)))
+                               for dataset_id in chunk_ids]
+            mocs = cds.query_regions(moc_constraints, output_format, max_workers=max_workers)
+            for dataset_id, moc in zip(chunk_ids, mocs):
+                yield dataset_id, moc
+
+    return MocStore.write(path, fetch_mocs(), moc_order)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""
+Array-based helpers for manipulating MOCs
+
+A MOC is represented here as a (n, 2) int64 numpy array of sorted, disjoint
+[start, end) ranges of HEALPix cells expressed at the deepest order (29),
+i.e. the same layout as the interval set of a mocpy object. Working on these
+arrays avoids the per-pixel python loops of mocpy when a MOC is loaded from
+a server response or combined with other MOCs.
+"""
+
+import io
+
+import numpy as np
+
+from astropy.io import fits
+from mocpy import MOC
+from mocpy.interval_set import IntervalSet
+
+MAX_ORDER = 29
+
+# uniq = 4 * 4**order + ipix so the order of a uniq is given by the
+# greatest 4**(order + 1) lower or equal to it
+_UNIQ_ORDER_THRESHOLDS = np.array([4 ** (order + 1) for order in range(MAX_ORDER + 1)], dtype=np.int64)
+
+
+def empty_ranges():
+    return np.zeros((0, 2), dtype=np.int64)
+
+
+def merge_ranges(ranges):
+    """Sort the ranges and merge the ones overlapping or touching each other"""
+    ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+    if len(ranges) == 0:
+        return empty_ranges()
+
+    ranges = ranges[np.argsort(ranges[:, 0], kind='stable')]
+    ends = np.maximum.accumulate(ranges[:, 1])
+    # a new range begins where the start is beyond all the ends seen so far
+    is_new = np.empty(len(ranges), dtype=bool)
+    is_new[0] = True
+    is_new[1:] = ranges[1:, 0] > ends[:-1]
+
+    first = np.flatnonzero(is_new)
+    last = np.append(first[1:] - 1, len(ranges) - 1)
+    return np.column_stack((ranges[first, 0], ends[last]))
+
+
+def orderipix_to_ranges(order, ipix):
+    """Convert HEALPix cells expressed at ``order`` into merged ranges at the deepest order"""
+    ipix = np.asarray(ipix, dtype=np.int64)
+    shift = np.asarray(2 * (MAX_ORDER - np.asarray(order, dtype=np.int64)), dtype=np.int64)
+    return merge_ranges(np.column_stack((ipix << shift, (ipix + 1) << shift)))
+
+
+def uniq_to_ranges(uniq):
+    """Convert an array of NUNIQ HEALPix cells into merged ranges at the deepest order"""
+    uniq = np.asarray(uniq, dtype=np.int64)
+    order = np.searchsorted(_UNIQ_ORDER_THRESHOLDS, uniq, side='right') - 1
+    ipix = uniq - _UNIQ_ORDER_THRESHOLDS[order]
+    return orderipix_to_ranges(order, ipix)
+
+
+def json_to_ranges(json_moc):
+    """Convert a MOC expressed as a dict of pixel lists indexed by their order"""
+    orders = []
+    ipix = []
+    for order, ipix_l in json_moc.items():
+        orders.append(np.full(len(ipix_l), int(order), dtype=np.int64))
+        ipix.append(np.asarray(ipix_l, dtype=np.int64))
+
+    if not ipix:
+        return empty_ranges()
+
+    return orderipix_to_ranges(np.concatenate(orders), np.concatenate(ipix))
+
+
+def ranges_to_moc(ranges):
+    """
+    Create a mocpy MOC object from merged ranges
+
+    mocpy 0.4 has no public accessor to the intervals of a MOC at the deepest order, nor
+    a public way to set them without merging them again one by one. This function and
+    `moc_to_ranges` are the only ones relying on the private attributes of mocpy, whose
+    version is pinned. test_mocpy_private_layout checks them against the public API of
+    mocpy so that an upgrade changing these attributes fails loudly.
+    """
+    interval_set = IntervalSet()
+    # The ranges are already sorted and merged so they are given as is to the interval set
+    # instead of being added one by one and merged again by mocpy
+    interval_set._intervals = [(int(start), int(end)) for start, end in ranges.tolist()]
+    return MOC.from_interval_set(interval_set)
+
+
+def moc_to_ranges(moc):
+    """Get the merged ranges of a mocpy object"""
+    intervals = moc._interval_set.intervals
+    if not intervals:
+        return empty_ranges()
+    return np.array(intervals, dtype=np.int64)
+
+
+def degrade_ranges(ranges, order):
+    """Degrade merged ranges to ``order``, the result covering at least the original ranges"""
+    shift = 2 * (MAX_ORDER - order)
+    mask = np.int64(~((1 << shift) - 1))
+    starts = ranges[:, 0] & mask
+    ends = (ranges[:, 1] + np.int64((1 << shift) - 1)) & mask
+    return merge_ranges(np.column_stack((starts, ends)))
+
+
+def coverage_segments(ranges_l):
+    """
+    Split the sky into segments covered by the same number of MOCs
+
+    Returns
+    -------
+    edges : `~numpy.ndarray`
+        The sorted bounds of the segments : the segment ``i`` is [edges[i], edges[i + 1])
+    counts : `~numpy.ndarray`
+        The number of MOCs covering each segment. The count of the last edge is 0.
+    """
+    ranges = np.concatenate([np.asarray(r, dtype=np.int64).reshape(-1, 2) for r in ranges_l] or [empty_ranges()])
+    edges, inverse = np.unique(ranges.ravel(), return_inverse=True)
+    # +1 at the start of each range, -1 at its end
+    deltas = np.zeros(len(edges), dtype=np.int64)
+    np.add.at(deltas, inverse.reshape(-1, 2)[:, 0], 1)
+    np.add.at(deltas, inverse.reshape(-1, 2)[:, 1], -1)
+    return edges, np.cumsum(deltas)
+
+
+def segments_to_ranges(edges, selected):
+    """The merged ranges of the segments [edges[i], edges[i + 1]) whose ``selected[i]`` is True"""
+    i = np.flatnonzero(selected[:-1])
+    return merge_ranges(np.column_stack((edges[i], edges[i + 1])))
+
+
+def union_ranges(a, b):
+    return merge_ranges(np.concatenate((a, b)))
+
+
+def intersection_ranges(a, b):
+    edges, counts = coverage_segments([a, b])
+    return segments_to_ranges(edges, counts == 2)
+
+
+def ranges_to_cells(ranges, order):
+    """The HEALPix cells at ``order`` touched by the ranges"""
+    shift = 2 * (MAX_ORDER - order)
+    first = ranges[:, 0] >> shift
+    last = (ranges[:, 1] - 1) >> shift
+    return np.unique(expand_ranges(first, last + 1))
+
+
+def ranges_to_full_cells(ranges, order):
+    """The HEALPix cells at ``order`` entirely covered by the ranges"""
+    shift = 2 * (MAX_ORDER - order)
+    first = (ranges[:, 0] + np.int64((1 << shift) - 1)) >> shift
+    end = ranges[:, 1] >> shift
+    return expand_ranges(first, end)
+
+
+def expand_ranges(first, end):
+    """Concatenation of the aranges [first[i], end[i])"""
+    lengths = np.maximum(end - first, 0)
+    if lengths.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.repeat(first - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return starts + np.arange(lengths.sum(), dtype=np.int64)
+
+
+def ranges_overlap(a, b):
+    """Tell whether two sets of merged ranges have at least one cell in common"""
+    if len(a) == 0 or len(b) == 0:
+        return False
+    # for each range of b, the first range of a ending after its start
+    i = np.searchsorted(a[:, 1], b[:, 0], side='right')
+    valid = i < len(a)
+    return bool(np.any(a[i[valid], 0] < b[valid, 1]))
+
+
+def ranges_include(a, b):
+    """Tell whether the merged ranges ``b`` lie entirely inside the merged ranges ``a``"""
+    if len(b) == 0:
+        return True
+    if len(a) == 0:
+        return False
+    # the range of a beginning right before each range of b must end after it
+    i = np.searchsorted(a[:, 0], b[:, 0], side='right') - 1
+    return bool(np.all((i >= 0) & (a[np.maximum(i, 0), 1] >= b[:, 1])))
+
+
+def ranges_contain(ranges, ipix):
+    """Tell which of the cells ``ipix`` (at the deepest order) lie in the ranges"""
+    ipix = np.asarray(ipix, dtype=np.int64)
+    if len(ranges) == 0:
+        return np.zeros(ipix.shape, dtype=bool)
+    i = np.searchsorted(ranges[:, 0], ipix, side='right') - 1
+    return (i >= 0) & (ipix < ranges[np.maximum(i, 0), 1])
+
+
+def uniq_from_fits(buffer):
+    """
+    Read the NUNIQ column of a MOC serialized in the FITS format
+
+    Only the headers are parsed by astropy. The column is returned as a read-only
+    view on ``buffer``, without copying the cells, unless it is scaled (TZERO/TSCAL)
+    in which case astropy applies the scaling.
+
+    Parameters
+    ----------
+    buffer : bytes
+        The content of a MOC FITS file
+
+    Returns
+    -------
+    uniq : `~numpy.ndarray`
+        The NUNIQ HEALPix cells of the MOC
+    """
+    with fits.open(io.BytesIO(buffer)) as hdu_l:
+        hdu = next((hdu for hdu in hdu_l[1:] if isinstance(hdu, fits.BinTableHDU)), None)
+        if hdu is None:
+            raise ValueError('No binary table found in the MOC FITS content')
+
+        column = hdu.columns[0]
+        if column.bscale is not None or column.bzero is not None:
+            return np.array(hdu.data.field(0))
+
+        # the rows are NAXIS1 bytes long, the NUNIQ column being the first one. The
+        # values of a FITS file are big-endian
+        dtype = hdu.columns.dtype[0].newbyteorder('>')
+        n_rows = hdu.header['NAXIS2']
+        offset = hdu.fileinfo()['datLoc']
+
+    if offset + n_rows * hdu.header['NAXIS1'] > len(buffer):
+        raise ValueError('The MOC FITS content is truncated')
+    return np.ndarray(shape=(n_rows,), dtype=dtype, buffer=buffer, offset=offset, strides=(hdu.header['NAXIS1'],))
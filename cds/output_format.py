@@ -14,11 +14,21 @@ class OutputFormat(object):
         moc = 4,
         i_moc = 5
 
-    def __init__(self, format=Type.id, field_l=[], moc_order=maxsize, case_sensitive=True, max_rec=None):
+    # The properties retrieved for each dataset of a lazy record query
+    LAZY_FIELDS = ['ID', 'obs_title', 'dataproduct_type', 'moc_sky_fraction']
+
+    def __init__(self, format=Type.id, field_l=[], moc_order=maxsize, case_sensitive=True, max_rec=None,
+                 moc_serialization='json', lazy=False):
         if not isinstance(format, OutputFormat.Type):
             print("The response format must have value in the ResponseFormat enum")
             raise TypeError
 
+        # MOCs can be transferred as json dictionaries or as FITS binary tables
+        # of NUNIQ cells which are much more compact and faster to parse
+        if moc_serialization not in ('json', 'fits'):
+            print("moc_serialization must have a value in ('json', 'fits')")
+            raise ValueError
+
         self.format = format
 
         if not isinstance(field_l, list) or not isinstance(case_sensitive, bool):
@@ -32,6 +42,15 @@ class OutputFormat(object):
         if max_rec and not isinstance(max_rec, int):
             raise TypeError
 
+        # A lazy record query only retrieves a few properties of the datasets,
+        # the others are fetched when they are read
+        if lazy and format is not OutputFormat.Type.record:
+            print("Only record queries can be lazy")
+            raise ValueError
+        self.lazy = lazy
+        if lazy:
+            field_l = field_l + [field for field in OutputFormat.LAZY_FIELDS if field not in field_l]
+
         if format is OutputFormat.Type.id:
             self.request_payload.update({'get': 'id'})
         elif format is OutputFormat.Type.record:
@@ -70,5 +89,7 @@ class OutputFormat(object):
             else:
                 self.request_payload.update({'get': 'moc'})
 
+            self.request_payload.update({'fmt': moc_serialization})
+
         if max_rec:
             self.request_payload.update({'MAXREC': str(max_rec)})
\ No newline at end of file
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .constraints import Constraints
+from .property_constraint import PropertyConstraint
+from .output_format import OutputFormat
+
+
+class ResultPager(object):
+    """
+    Iterator over the records matching some constraints, one page at a time
+
+    The MOCServer cannot skip the first records of a result, so each page is asked
+    for with a properties constraint keeping the datasets whose ID lies after the last
+    ID of the previous page, its size being bounded with MAXREC. The MOCServer lists
+    the datasets sorted by ID, so that the pages follow each other. The number of
+    datasets to page through is probed first with a ``number`` query, which gives the
+    number of pages : only the records of the current page and of the next one are
+    held in memory. While a page is being processed, the next one is fetched in the
+    background.
+
+    The pager keeps a cursor, the ID of the last dataset of the last page that has been
+    entirely processed (i.e. the iteration asked for the page after it). A pager created
+    with this cursor resumes the iteration after it, so that a long export interrupted
+    by a network failure does not start over.
+
+    Parameters
+    ----------
+    constraints : Constraints
+        The constraints the datasets must match
+    field_l : [str], optional
+        The properties to retrieve. All the properties are retrieved by default.
+    page_size : int
+        The number of datasets of each page
+    prefetch : bool
+        Fetch the next page while the current one is processed
+    cursor : str, optional
+        The cursor of a previous iteration to resume
+    cds : CdsClass, optional
+        The client used to query the MOCServer
+
+    """
+
+    def __init__(self, constraints, field_l=None, page_size=500, prefetch=True, cursor=None, cds=None):
+        if not isinstance(constraints, Constraints):
+            print("Invalid constraints. Must be of MOCServerConstraints type")
+            raise TypeError
+
+        if cds is None:
+            from .core import cds
+
+        self.constraints = constraints
+        self.field_l = field_l
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.cursor = cursor
+        self.__cds = cds
+        self.__number = None
+
+    def count(self):
+        """
+        The number of matching datasets, probed without retrieving them
+
+        The MOCServer is queried once, the number being kept for the next calls.
+        """
+        if self.__number is None:
+            self.__number = self.__count_after(None)
+        return self.__number
+
+    def __count_after(self, cursor):
+        result = self.__cds.query_region(self.__constraints_after(cursor),
+                                         OutputFormat(format=OutputFormat.Type.number))
+        return int(result['number'])
+
+    def __constraints_after(self, cursor):
+        """The constraints of the pager restricted to the datasets whose ID lies after ``cursor``"""
+        if cursor is None:
+            return self.constraints
+
+        properties_constraint = self.constraints.properties_constraint
+        expr = 'ID>{0}'.format(cursor)
+        if properties_constraint is not None:
+            expr = '({0}) && {1}'.format(properties_constraint.request_payload['expr'], expr)
+        return Constraints(sc=self.constraints.spatial_constraint, pc=PropertyConstraint(expr),
+                           tc=self.constraints.temporal_constraint)
+
+    def __fetch_page(self, cursor):
+        field_l = list(self.field_l or [])
+        if field_l and 'ID' not in field_l:
+            field_l.append('ID')
+        datasets = self.__cds.query_region(self.__constraints_after(cursor),
+                                           OutputFormat(format=OutputFormat.Type.record, field_l=field_l,
+                                                        max_rec=self.page_size))
+        # the datasets of the page are given in the order of their IDs
+        return dict((dataset_id, datasets[dataset_id]) for dataset_id in sorted(datasets.keys()))
+
+    def __iter__(self):
+        # the number of datasets left sizes the work, so that no query is sent after the last page
+        n_remaining = self.count() if self.cursor is None else self.__count_after(self.cursor)
+        n_pages = -(-n_remaining // self.page_size)
+        if n_pages == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.__fetch_page, self.cursor)
+            for i in range(n_pages):
+                page = future.result()
+                if not page:
+                    # the datasets have been deleted since the number was probed
+                    return
+                last_id = next(reversed(page))
+                has_next = i + 1 < n_pages
+                if self.prefetch and has_next:
+                    future = executor.submit(self.__fetch_page, last_id)
+
+                yield page
+
+                # The page has been processed once the next one is asked for
+                self.cursor = last_id
+                if not self.prefetch and has_next:
+                    future = executor.submit(self.__fetch_page, last_id)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+import re
+from enum import Enum
+
+
+class PropertyType(Enum):
+    """Type of the values of a dataset property"""
+    numeric = 1,
+    string = 2
+
+
+class PropertyTypeRegistry(object):
+    """
+    Registry of the types of the dataset properties
+
+    The MOCServer sends all the property values as strings. The type of a property is
+    inferred from its first non empty value and cached, so that the values of the
+    following records, and of the following queries, are converted by property instead
+    of trying to convert every value to a float. The values of string properties are
+    kept as is without raising and catching any exception. A value of a numeric
+    property that is not a number (e.g. empty) is kept as a string.
+
+    Multi-valued properties (sent as lists) have their duplicates removed, keeping
+    the order in which the MOCServer gives them. A list reduced to one value is
+    replaced by this value.
+
+    """
+
+    NUMBER_REGEX = re.compile(r'[-+]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|inf|infinity|nan)', re.IGNORECASE)
+
+    def __init__(self):
+        self.__types = {}
+
+    def __getitem__(self, key):
+        return self.__types[key]
+
+    def __contains__(self, key):
+        return key in self.__types
+
+    def clear(self):
+        self.__types.clear()
+
+    def infer(self, key, value):
+        """
+        Infer the type of a property from one of its values and remember it
+
+        The empty values do not tell the type of a property : None is then returned
+        and the type is inferred from the next value.
+        """
+        values = [v for v in (value if isinstance(value, list) else [value]) if v != '']
+        if not values:
+            return None
+
+        is_number = PropertyTypeRegistry.NUMBER_REGEX.fullmatch
+        if all(isinstance(v, str) and is_number(v.strip()) for v in values):
+            property_type = PropertyType.numeric
+        else:
+            property_type = PropertyType.string
+
+        self.__types[key] = property_type
+        return property_type
+
+    def parse(self, record):
+        """
+        Convert the values of a record according to the types of its properties
+
+        Parameters
+        ----------
+        record : {str : str or [str]}
+            a record as sent by the MOCServer
+
+        Returns
+        -------
+        record : {str : _}
+            the record whose numeric values have been converted to floats
+        """
+        types = self.__types
+        to_float = PropertyTypeRegistry.__to_float
+        parsed = {}
+        for key, value in record.items():
+            property_type = types.get(key)
+            if property_type is None:
+                property_type = self.infer(key, value)
+
+            if isinstance(value, list):
+                # dict.fromkeys removes the duplicates and keeps the order of the values
+                value = list(dict.fromkeys(value))
+                if property_type is PropertyType.numeric:
+                    value = [to_float(v) for v in value]
+                if len(value) == 1:
+                    value = value[0]
+            elif property_type is PropertyType.numeric:
+                value = to_float(value)
+
+            parsed[key] = value
+
+        return parsed
+
+    @staticmethod
+    def __to_float(value):
+        # Only called on the values of numeric properties so the exception
+        # is only raised in the rare case of a malformed or empty value
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+import random
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlparse
+
+import requests
+
+HostStats = namedtuple('HostStats', ['concurrency_limit', 'in_flight', 'rate', 'requests', 'errors',
+                                     'retries', 'mean_latency'])
+
+# HTTP status codes sent back by an overloaded server
+OVERLOAD_STATUS_CODES = (429, 502, 503, 504)
+
+
+class _HostState(object):
+    """Token bucket and AIMD concurrency limit of one host"""
+
+    def __init__(self, limiter):
+        self.condition = threading.Condition()
+        self.tokens = float(limiter.burst)
+        self.last_refill = time.monotonic()
+        self.concurrency_limit = float(limiter.initial_concurrency)
+        self.last_decrease = 0.
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency = 0.
+
+
+class AdaptiveLimiter(object):
+    """
+    Client-side rate and concurrency limiter, one per set of servers queried
+
+    Each host gets its own token bucket, bounding the rate of the requests sent to it,
+    and its own concurrency limit, i.e. the number of requests running at the same
+    time. The concurrency limit follows an AIMD (additive increase, multiplicative
+    decrease) scheme : it grows by about one request for each round of requests
+    answered in time, and is multiplied by ``decrease_factor`` when a request fails
+    because of an overloaded server or takes more than ``target_latency`` seconds.
+    Failed requests are retried after a jittered exponential backoff.
+
+    The ``max_workers`` parameters of the queries remain upper bounds : the limiter
+    only delays requests that would overload the server.
+
+    Parameters
+    ----------
+    rate : float
+        The number of requests per second sent to each host
+    burst : int
+        The number of requests that can be sent at once to a host that has been idle
+    initial_concurrency : int
+        The concurrency limit of a host that has not been queried yet
+    max_concurrency : int
+        The greatest concurrency limit of a host
+    target_latency : float
+        The duration in seconds beyond which a request is considered slowed down by an overload
+    decrease_factor : float
+        The factor applied to the concurrency limit after a failed or slow request
+    max_retries : int
+        The number of times a failed request is retried
+    backoff_base : float
+        The backoff in seconds before the first retry, doubled at each retry
+    backoff_max : float
+        The greatest backoff in seconds
+
+    """
+
+    def __init__(self, rate=50., burst=50, initial_concurrency=4, max_concurrency=32, target_latency=10.,
+                 decrease_factor=0.5, max_retries=4, backoff_base=0.5, backoff_max=30.):
+        self.rate = rate
+        self.burst = burst
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.__hosts = {}
+        self.__lock = threading.Lock()
+
+    def __host(self, url):
+        host = urlparse(url).netloc or url
+        with self.__lock:
+            if host not in self.__hosts:
+                self.__hosts[host] = _HostState(self)
+            return self.__hosts[host]
+
+    def stats(self):
+        """
+        The current limits and counters of each host queried so far
+
+        Returns
+        -------
+        stats : {str : HostStats}
+            The stats indexed by host name
+        """
+        with self.__lock:
+            hosts = dict(self.__hosts)
+
+        stats = {}
+        for host, state in hosts.items():
+            with state.condition:
+                stats[host] = HostStats(concurrency_limit=state.concurrency_limit, in_flight=state.in_flight,
+                                        rate=self.rate, requests=state.requests, errors=state.errors,
+                                        retries=state.retries,
+                                        mean_latency=state.total_latency / state.requests if state.requests else 0.)
+        return stats
+
+    def call(self, url, func):
+        """
+        Run ``func()``, a request sent to ``url``, within the limits of its host
+
+        The request is retried when it raises a timeout, when it
+        returns a response with an overload status code (429, 502, 503 or 504), or when
+        it raises an error wrapping one of these (e.g. a pyvo DALServiceError). The last
+        response is returned as is and the last error is raised once all the retries
+        have failed.
+        """
+        state = self.__host(url)
+        attempt = 0
+        while True:
+            start = self.__acquire(state)
+            try:
+                result = func()
+            except Exception as error:
+                overloaded = AdaptiveLimiter.__is_overload_error(error)
+                self.__release(state, start, overloaded)
+                if not overloaded or attempt >= self.max_retries:
+                    raise
+            else:
+                overloaded = getattr(result, 'status_code', None) in OVERLOAD_STATUS_CODES
+                self.__release(state, start, overloaded)
+                if not overloaded or attempt >= self.max_retries:
+                    return result
+
+            with state.condition:
+                state.retries += 1
+            # "full jitter" : the clients retrying at the same time are spread over the backoff
+            time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+            attempt += 1
+
+    def __acquire(self, state):
+        with state.condition:
+            while True:
+                now = time.monotonic()
+                state.tokens = min(float(self.burst), state.tokens + (now - state.last_refill) * self.rate)
+                state.last_refill = now
+                if state.in_flight < max(1, int(state.concurrency_limit)) and state.tokens >= 1:
+                    state.tokens -= 1
+                    state.in_flight += 1
+                    return now
+
+                # wait for a request to end or for the next token
+                state.condition.wait(timeout=None if state.tokens >= 1 else (1 - state.tokens) / self.rate)
+
+    def __release(self, state, start, overloaded):
+        latency = time.monotonic() - start
+        with state.condition:
+            state.in_flight -= 1
+            state.requests += 1
+            state.total_latency += latency
+            if overloaded:
+                state.errors += 1
+
+            if overloaded or latency > self.target_latency:
+                # The requests sent before the last decrease do not decrease the limit again :
+                # they were already slowed down by the overload that caused it
+                if start > state.last_decrease:
+                    state.concurrency_limit = max(1., state.concurrency_limit * self.decrease_factor)
+                    state.last_decrease = time.monotonic()
+            else:
+                state.concurrency_limit = min(float(self.max_concurrency),
+                                              state.concurrency_limit + 1. / state.concurrency_limit)
+            state.condition.notify_all()
+
+    @staticmethod
+    def __is_overload_error(error):
+        # the other connection errors (DNS failures, refused connections...) do not tell
+        # an overload and are raised at once
+        if isinstance(error, requests.exceptions.Timeout):
+            return True
+        code = getattr(error, 'code', None)
+        if code is None and getattr(error, 'response', None) is not None:
+            code = error.response.status_code
+        if code in OVERLOAD_STATUS_CODES:
+            return True
+        cause = getattr(error, 'cause', None)
+        return cause is not error and isinstance(cause, Exception) and AdaptiveLimiter.__is_overload_error(cause)
+
+
+# The limiter shared by the MOCServer queries and the searches in the datasets
+limiter = AdaptiveLimiter()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+import glob
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from astropy import units as u
+from astropy.config import paths
+from astropy.coordinates import SkyCoord
+from astropy.io import votable
+from astropy.time import Time
+
+
+def _canonical(value):
+    """A string identifying a search parameter whatever the way it has been built"""
+    if isinstance(value, SkyCoord):
+        # rounded to ~4 micro-arcseconds so that the same position converted from
+        # another frame gives the same key
+        value = value.icrs
+        return 'SkyCoord({0}, {1})'.format(_canonical(np.round(value.ra.deg, 9)),
+                                           _canonical(np.round(value.dec.deg, 9)))
+    if isinstance(value, u.Quantity):
+        if value.unit.physical_type == 'angle':
+            # the angles are given in degrees like the bare floats, which pyvo takes as
+            # degrees, so that 0.1, 0.1 * u.deg and 6 * u.arcmin give the same key
+            return _canonical(np.round(value.to_value(u.deg), 9))
+        return '{0} {1}'.format(_canonical(value.value), value.unit.to_string())
+    if isinstance(value, Time):
+        return 'Time({0})'.format(_canonical(value.isot))
+    if isinstance(value, np.ndarray):
+        return _canonical(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return '[{0}]'.format(', '.join(_canonical(v) for v in value))
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    if isinstance(value, (int, np.integer)):
+        return repr(int(value))
+    return repr(str(value))
+
+
+def _hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+class SearchCache(object):
+    """
+    On-disk cache of the VOTables returned by Dataset.search
+
+    The results are indexed by the ID of the dataset, the type of the service and the
+    search parameters, so that the result of a search is found again whichever mirror
+    of the service answered it. The entries also depend on the version of the dataset,
+    given by the value of its ``version_property`` : a result fetched before the dataset
+    has been released again is deleted instead of being returned.
+
+    The VOTables are stored in the BINARY2 serialization. Once the files of the cache
+    exceed ``max_bytes``, the least recently read ones are deleted.
+
+    Parameters
+    ----------
+    path : str, optional
+        The directory of the cache. Defaults to ``astroquery/cds_search`` in the
+        astropy cache directory.
+    max_bytes : int
+        The greatest total size of the cached VOTables
+    version_property : str
+        The property of the datasets telling their version
+
+    """
+
+    EXTENSION = '.vot'
+
+    def __init__(self, path=None, max_bytes=1024 ** 3, version_property='moc_release_date'):
+        if path is None:
+            path = os.path.join(paths.get_cache_dir(), 'astroquery', 'cds_search')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version_property = version_property
+        self.__lock = threading.Lock()
+        self.__size = None
+
+    def key(self, dataset, service_type, search_kwargs):
+        """
+        The name of the file of an entry : a hash of the search followed by a hash of the version
+        """
+        search = '{0} {1} {2}'.format(dataset.properties['ID'], service_type.name,
+                                      ', '.join('{0}={1}'.format(name, _canonical(value))
+                                                for name, value in sorted(search_kwargs.items())))
+        version = str(dataset.properties.get(self.version_property, ''))
+        return '{0}-{1}'.format(_hash(search), _hash(version))
+
+    def get(self, dataset, service_type, search_kwargs):
+        """The cached VOTable of a search, None if it has not been cached for this version of the dataset"""
+        key = self.key(dataset, service_type, search_kwargs)
+        filename = os.path.join(self.path, key + SearchCache.EXTENSION)
+        try:
+            result = votable.parse(filename)
+        except (IOError, OSError):
+            self.__delete_other_versions(key)
+            return None
+
+        # the modification time of the files gives the order of eviction
+        os.utime(filename)
+        return result
+
+    def put(self, dataset, service_type, search_kwargs, result):
+        """Cache the VOTable of a search"""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        key = self.key(dataset, service_type, search_kwargs)
+        filename = os.path.join(self.path, key + SearchCache.EXTENSION)
+        # written to a temporary file first so that a reader never sees a truncated VOTable
+        tmp_filename = '{0}.{1}.tmp'.format(filename, threading.get_ident())
+        result.to_xml(tmp_filename, tabledata_format='binary2')
+        size = os.path.getsize(tmp_filename)
+
+        with self.__lock:
+            # an entry written again replaces the previous file of the same size or not
+            replaced_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+            os.replace(tmp_filename, filename)
+            if self.__size is None:
+                self.__size = sum(os.path.getsize(f) for f in self.__files())
+            else:
+                self.__size += size - replaced_size
+            if self.__size > self.max_bytes:
+                self.__evict()
+
+    def clear(self):
+        with self.__lock:
+            for f in self.__files():
+                os.remove(f)
+            self.__size = 0
+
+    def __files(self):
+        return glob.glob(os.path.join(self.path, '*' + SearchCache.EXTENSION))
+
+    def __delete_other_versions(self, key):
+        search_hash = key.split('-')[0]
+        deleted_size = 0
+        for f in glob.glob(os.path.join(self.path, search_hash + '-*' + SearchCache.EXTENSION)):
+            try:
+                size = os.path.getsize(f)
+                os.remove(f)
+                deleted_size += size
+            except OSError:
+                pass
+        if deleted_size:
+            # the running total is kept instead of scanning the directory again on the next put
+            with self.__lock:
+                if self.__size is not None:
+                    self.__size -= deleted_size
+
+    def __evict(self):
+        files = sorted((os.path.getmtime(f), os.path.getsize(f), f) for f in self.__files())
+        self.__size = sum(size for _, size, _ in files)
+        for _, size, f in files:
+            if self.__size <= self.max_bytes:
+                break
+            os.remove(f)
+            self.__size -= size
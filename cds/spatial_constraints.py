@@ -3,14 +3,26 @@
 
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 
+import json
 from os import remove
 
 from abc import abstractmethod, ABC
 
+import numpy as np
+import requests
+from astropy import units as u
+from astropy.coordinates import Angle, SkyCoord
+
+from astropy_healpix import HEALPix
+
 from regions import CircleSkyRegion
 from regions import PolygonSkyRegion
 from mocpy import MOC
 
+from . import conf
+from . import moc_utils
+from .rate_limit import limiter
+
 
 class SpatialConstraint(ABC):
     """
@@ -56,12 +68,95 @@ class SpatialConstraint(ABC):
         self.__intersect = value
         self.request_payload.update({'intersect': self.__intersect})
 
+    @abstractmethod
+    def healpix_ranges(self, order):
+        """
+        HEALPix coverage of the region of the constraint
+
+        Returns the merged ranges (see moc_utils) of the cells at ``order``
+        overlapping the region. Used to evaluate the constraint locally.
+        """
+
     # real signature unknown
     def __repr__(self, *args, **kwargs):
         result = "Spatial constraint having request payload :\n{0}".format(self.request_payload)
         return result
 
 
+def to_decimal_str(values):
+    """
+    Format an array of angles expressed in degrees into decimal strings
+
+    The whole array is formatted in one numpy pass, which is much cheaper
+    than calling astropy.coordinates.Angle.to_string on each of its items
+
+    """
+    return np.asarray(values, dtype=np.float64).astype(str)
+
+
+def _to_xyz(lon, lat):
+    """Unit vectors of positions expressed in radians"""
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)))
+
+
+def _cell_bounds(hp, cells):
+    """
+    Unit vectors of the centers of HEALPix cells and radius (in radians) of a circle
+    around each center enclosing the whole cell
+    """
+    cell_lon, cell_lat = hp.healpix_to_lonlat(cells)
+    cell_xyz = _to_xyz(cell_lon.to_value(u.rad), cell_lat.to_value(u.rad))
+
+    # radius of the cells, measured on their corners and on the middle of their edges
+    bound_lon, bound_lat = hp.boundaries_lonlat(cells, step=2)
+    bound_xyz = _to_xyz(bound_lon.to_value(u.rad).ravel(), bound_lat.to_value(u.rad).ravel())
+    cos_bound = np.einsum('ijk,ik->ij', bound_xyz.reshape(len(cells), -1, 3), cell_xyz)
+    return cell_xyz, 1.05 * np.arccos(np.clip(cos_bound.min(axis=1), -1, 1))
+
+
+def _refine_ranges(classify, order):
+    """
+    HEALPix coverage of a region, refined hierarchically from order 0
+
+    ``classify(hp, cells)`` tells which cells lie entirely inside the region and
+    which ones cross its border. The cells inside are kept as is and only the
+    cells crossing the border are split into their 4 children. The result contains
+    all the cells at ``order`` overlapping the region.
+    """
+    kept_orders = []
+    kept_cells = []
+    cells = np.arange(12, dtype=np.int64)
+    for cur_order in range(order + 1):
+        if len(cells) == 0:
+            # no cell crosses the border of the region
+            break
+        inside, border = classify(HEALPix(nside=2 ** cur_order, order='nested'), cells)
+        if cur_order == order:
+            kept = inside | border
+            kept_orders.append(np.full(kept.sum(), cur_order))
+            kept_cells.append(cells[kept])
+        else:
+            kept_orders.append(np.full(inside.sum(), cur_order))
+            kept_cells.append(cells[inside])
+            cells = (4 * cells[border & ~inside][:, None] + np.arange(4)).ravel()
+
+    return moc_utils.orderipix_to_ranges(np.concatenate(kept_orders), np.concatenate(kept_cells))
+
+
+def _cone_ranges(lon, lat, radius, order):
+    """HEALPix coverage of a cone, expressed in radians"""
+    center = _to_xyz(np.atleast_1d(lon), np.atleast_1d(lat))[0]
+
+    def classify(hp, cells):
+        cell_xyz, cell_radius = _cell_bounds(hp, cells)
+        distance = np.arccos(np.clip(cell_xyz.dot(center), -1, 1))
+        return distance + cell_radius <= radius, distance - cell_radius <= radius
+
+    return _refine_ranges(classify, order)
+
+
 class Cone(SpatialConstraint):
     """
     Class defining a circle sky region
@@ -94,12 +189,132 @@ class Cone(SpatialConstraint):
 
         super(Cone, self).__init__(intersect)
         self.circle_region = circle_region
+
+    @property
+    def circle_region(self):
+        # Cones taken from a Cones collection only build their region when it is asked for
+        if self.__circle_region is None:
+            center, radius = self.__lazy_region
+            self.__circle_region = CircleSkyRegion(center, radius)
+        return self.__circle_region
+
+    @circle_region.setter
+    def circle_region(self, circle_region):
+        if not isinstance(circle_region, CircleSkyRegion):
+            raise TypeError
+
+        self.__circle_region = circle_region
+        self.__lazy_region = None
+        # SR is expressed in degrees whatever the unit of the radius
+        ra, dec, radius = to_decimal_str([circle_region.center.icrs.ra.deg,
+                                          circle_region.center.icrs.dec.deg,
+                                          circle_region.radius.to_value(u.deg)])
         self.request_payload.update({
-            'DEC': circle_region.center.dec.to_string(decimal=True),
-            'RA': circle_region.center.ra.to_string(decimal=True),
-            'SR': str(circle_region.radius.value)
+            'DEC': dec,
+            'RA': ra,
+            'SR': radius
         })
 
+    def healpix_ranges(self, order):
+        center = self.circle_region.center.icrs
+        return _cone_ranges(center.ra.rad, center.dec.rad, self.circle_region.radius.to_value(u.rad), order)
+
+    @classmethod
+    def _from_payload(cls, request_payload, center, radius):
+        cone = cls.__new__(cls)
+        SpatialConstraint.__init__(cone, request_payload['intersect'])
+        cone.request_payload.update(request_payload)
+        cone.__circle_region = None
+        cone.__lazy_region = (center, radius)
+        return cone
+
+    @classmethod
+    def from_arrays(cls, center, radius, intersect='overlaps'):
+        """
+        Build many cone constraints at once
+
+        Parameters:
+        ----
+        center : astropy.coordinates.SkyCoord
+            array of the centers of the cones
+        radius : astropy.coordinates.Angle
+            radius of the cones. Either a scalar shared by all the cones
+            or an array having the same length as ``center``
+        intersect : string
+            same as for a single cone
+
+        Returns:
+        ----
+        cones : Cones
+            the array-backed collection of the cone constraints
+
+        """
+        return Cones(center, radius, intersect=intersect)
+
+
+class Cones(object):
+    """
+    Array-backed collection of cone constraints
+
+    The payloads of all the cones are formatted in one vectorized pass
+    when the collection is created. Indexing the collection gives a
+    Cone constraint whose CircleSkyRegion is only built if it is accessed.
+    CdsClass.query_regions reads the payloads directly without creating
+    any Cone object
+
+    """
+
+    def __init__(self, center, radius, intersect='overlaps'):
+        if not isinstance(center, SkyCoord):
+            raise TypeError
+
+        if intersect not in ('overlaps', 'enclosed', 'covers'):
+            print("intersect parameters must have a value in ('overlaps', 'enclosed', 'covers')")
+            raise ValueError
+
+        center = center.icrs.reshape(-1)
+        radius = np.broadcast_to(Angle(radius, unit=u.deg).deg, (len(center),))
+
+        self.center = center
+        self.radius = Angle(radius, unit=u.deg)
+        self.intersect = intersect
+        self.ra = to_decimal_str(center.ra.deg)
+        self.dec = to_decimal_str(center.dec.deg)
+        self.sr = to_decimal_str(radius)
+
+    def __len__(self):
+        return len(self.ra)
+
+    def __getitem__(self, index):
+        """A Cone constraint, or a Cones collection when ``index`` is a slice"""
+        if isinstance(index, slice):
+            cones = Cones.__new__(Cones)
+            cones.center = self.center[index]
+            cones.radius = self.radius[index]
+            cones.intersect = self.intersect
+            cones.ra = self.ra[index]
+            cones.dec = self.dec[index]
+            cones.sr = self.sr[index]
+            return cones
+        return Cone._from_payload(self.request_payload(index), self.center[index], self.radius[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def request_payload(self, index):
+        return {
+            'intersect': self.intersect,
+            'DEC': self.dec[index],
+            'RA': self.ra[index],
+            'SR': self.sr[index]
+        }
+
+    def request_payloads(self):
+        """Generator giving the request payload of each cone"""
+        for index in range(len(self)):
+            yield self.request_payload(index)
+
 
 class Polygon(SpatialConstraint):
     """
@@ -112,7 +327,7 @@ class Polygon(SpatialConstraint):
 
     """
 
-    def __init__(self, polygon_region, intersect='overlaps'):
+    def __init__(self, polygon_region, intersect='overlaps', simplify_tolerance=None):
         """
         PolygonSkyRegionSpatialConstraint's constructor
 
@@ -121,6 +336,11 @@ class Polygon(SpatialConstraint):
         polygon_region : regions.PolygonSkyRegion
             defines a Polygon expressed as a list of vertices
             of type regions.SkyCoord
+        simplify_tolerance : astropy.coordinates.Angle, optional
+            if given, the vertices of the polygon are decimated so that
+            each removed vertex lies within this angular distance of the
+            simplified outline. Useful for detailed footprints whose STC
+            string would otherwise exceed the server URL limits
 
         Exceptions:
         ----
@@ -144,25 +364,146 @@ class Polygon(SpatialConstraint):
             print("A polygon must have at least 3 vertices")
             raise AttributeError
 
-        self.request_payload.update({'stc' : self.__to_stc(polygon_region)})
+        ra = polygon_region.vertices.ra.deg
+        dec = polygon_region.vertices.dec.deg
+        if simplify_tolerance is not None:
+            tolerance = Angle(simplify_tolerance, unit=u.deg).rad
+            kept = Polygon.__simplify(ra, dec, tolerance)
+            ra, dec = ra[kept], dec[kept]
+
+        self.polygon_region = polygon_region
+        self.request_payload.update({'stc': self.__to_stc(ra, dec)})
+
+    def healpix_ranges(self, order):
+        """
+        HEALPix coverage of the polygon
+
+        The cells are refined hierarchically like the ones of a cone : a cell is
+        split while the circle enclosing it reaches an edge of the polygon, and is
+        kept as is once this circle lies entirely inside the polygon. All the cells
+        at ``order`` touched by the polygon are kept, including the ones only crossed
+        by an edge, plus a few cells lying just outside of its edges.
+        """
+        vertices = self.polygon_region.vertices.icrs
+        xyz = _to_xyz(vertices.ra.rad, vertices.dec.rad)
+        center = xyz.sum(axis=0)
+        center /= np.linalg.norm(center)
+
+        def classify(hp, cells):
+            cell_xyz, cell_radius = _cell_bounds(hp, cells)
+            to_edges = np.min([Polygon.__arc_distance(cell_xyz, xyz[i - 1], xyz[i]) for i in range(len(xyz))],
+                              axis=0)
+            border = to_edges <= cell_radius
+            return ~border & Polygon.__contains(xyz, center, cell_xyz), border
+
+        return _refine_ranges(classify, order)
 
     @staticmethod
-    def __to_stc(polygon_region):
+    def __contains(vertices, center, points):
+        """Even-odd test of points inside a polygon in the gnomonic projection centered on the polygon"""
+        e1 = np.cross([0., 0., 1.], center)
+        if np.linalg.norm(e1) == 0:
+            e1 = np.array([1., 0., 0.])
+        e1 /= np.linalg.norm(e1)
+        e2 = np.cross(center, e1)
+
+        def project(p):
+            depth = p.dot(center)
+            return p.dot(e1) / depth, p.dot(e2) / depth, depth
+
+        vx, vy, _ = project(vertices)
+        px, py, depth = project(points)
+        inside = np.zeros(len(points), dtype=bool)
+        for i in range(len(vx)):
+            x1, y1, x2, y2 = vx[i - 1], vy[i - 1], vx[i], vy[i]
+            crosses = (y1 > py) != (y2 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (px < x_cross)
+
+        # points on the opposite hemisphere cannot be projected
+        return inside & (depth > 0)
+
+    @staticmethod
+    def __to_stc(ra, dec):
         """
-        Convert a regions.PolygonSkyRegion instance to a string
+        Convert the vertices of a polygon to a string
 
         MOCServer requests for a polygon expressed in a STC format
         i.e. a string beginning with 'Polygon' and iterating through
-        all the vertices' ra and dec
+        all the vertices' ra and dec. All the vertices are formatted
+        in one pass instead of calling Angle.to_string on each of them
+
+        """
+
+        coords = np.column_stack((to_decimal_str(ra), to_decimal_str(dec)))
+        return 'Polygon ' + ' '.join(coords.ravel().tolist())
+
+    @staticmethod
+    def __simplify(ra, dec, tolerance):
+        """
+        Douglas-Peucker decimation of a closed spherical polygon
+
+        Returns the sorted indices of the vertices to keep. Every vertex dropped
+        lies within ``tolerance`` radians (great-circle distance) of the arc
+        joining the kept vertices surrounding it.
 
         """
 
-        polygon_stc = "Polygon"
-        for i in range(len(polygon_region.vertices.ra)):
-            polygon_stc += ' ' + polygon_region.vertices.ra[i].to_string(decimal=True) + \
-                           ' ' + polygon_region.vertices.dec[i].to_string(decimal=True)
+        xyz = _to_xyz(np.radians(ra), np.radians(dec))
+        n_vertices = len(xyz)
+
+        # The ring is closed, so it is split in two chains at the first vertex and
+        # at the vertex lying the farthest from it
+        dist_first = Polygon.__angle(xyz, xyz[0])
+        far = int(np.argmax(dist_first))
+        # Index n_vertices refers back to the first vertex to close the ring
+        ring = np.vstack((xyz, xyz[:1]))
+
+        keep = np.zeros(n_vertices + 1, dtype=bool)
+        keep[[0, far, n_vertices]] = True
+        stack = [(0, far), (far, n_vertices)]
+        while stack:
+            start, end = stack.pop()
+            if end - start < 2:
+                continue
+            dist = Polygon.__arc_distance(ring[start + 1:end], ring[start], ring[end])
+            i_max = int(np.argmax(dist))
+            if dist[i_max] > tolerance:
+                split = start + 1 + i_max
+                keep[split] = True
+                stack.append((start, split))
+                stack.append((split, end))
+
+        keep = keep[:n_vertices]
+        if keep.sum() < 3:
+            # Both chains are within the tolerance of the same arc. Keep the vertex
+            # that is the farthest from it so that the result is still a polygon
+            dist = Polygon.__arc_distance(xyz, xyz[0], xyz[far])
+            dist[[0, far]] = -1
+            keep[int(np.argmax(dist))] = True
+
+        return np.flatnonzero(keep)
 
-        return polygon_stc
+    @staticmethod
+    def __angle(p, a):
+        return np.arctan2(np.linalg.norm(np.cross(p, a), axis=-1), np.dot(p, a))
+
+    @staticmethod
+    def __arc_distance(p, a, b):
+        """Angular distance between the points ``p`` and the great circle arc going from ``a`` to ``b``"""
+        normal = np.cross(a, b)
+        norm = np.linalg.norm(normal)
+        to_endpoints = np.minimum(Polygon.__angle(p, a), Polygon.__angle(p, b))
+        if norm == 0:
+            return to_endpoints
+
+        normal /= norm
+        cross_track = np.arcsin(np.clip(np.abs(np.dot(p, normal)), 0, 1))
+        # The projection of p onto the great circle must lie between a and b
+        # for the cross-track distance to be the distance to the arc
+        within_arc = (np.dot(np.cross(a, p), normal) >= 0) & (np.dot(np.cross(p, b), normal) >= 0)
+        return np.where(within_arc, cross_track, to_endpoints)
 
 
 class Moc(SpatialConstraint):
@@ -170,6 +511,8 @@ class Moc(SpatialConstraint):
         """Contruct a constraint based on the surface covered by a moc"""
         self.request_payload = {}
         super(Moc, self).__init__(intersect)
+        # the ranges of the MOC, loaded from its file or its url when they are first needed
+        self.__ranges = None
 
     @classmethod
     def from_file(cls, filename, intersect='overlaps'):
@@ -206,5 +549,38 @@ class Moc(SpatialConstraint):
         os.unlink(tmp_moc_file.name)
 
         moc_constraint = cls(intersect=intersect)
-        moc_constraint.request_payload.update({'moc': content})
+        # the content of the MOC is uploaded as is, like a MOC file
+        moc_constraint.request_payload.update({'moc': content.encode('utf-8')})
+        moc_constraint.__ranges = moc_utils.moc_to_ranges(mocpy_obj)
         return moc_constraint
+
+    def healpix_ranges(self, order):
+        """
+        HEALPix coverage of the MOC
+
+        The ranges of the MOC are read from its file, or downloaded from its url, the
+        first time they are needed. They are degraded to ``order`` when the MOC is deeper.
+        """
+        if self.__ranges is None:
+            if 'url' in self.request_payload:
+                url = self.request_payload['url']
+
+                def fetch():
+                    response = requests.get(url, timeout=conf.timeout)
+                    response.raise_for_status()
+                    return response.content
+
+                # the download goes through the limiter shared with the MOCServer queries
+                content = limiter.call(url, fetch)
+            else:
+                with open(self.request_payload['moc'], 'rb') as f_in:
+                    content = f_in.read()
+            self.__ranges = Moc.__parse(content)
+        return moc_utils.degrade_ranges(self.__ranges, order)
+
+    @staticmethod
+    def __parse(content):
+        # MOCs are serialized either in FITS or in JSON
+        if content.startswith(b'SIMPLE'):
+            return moc_utils.uniq_to_ranges(moc_utils.uniq_from_fits(content))
+        return moc_utils.json_to_ranges(json.loads(content.decode('utf-8')))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+from abc import abstractmethod, ABC
+
+import numpy as np
+from astropy.time import Time
+
+from mocpy import MOC, TimeMoc
+
+from .spatial_constraints import SpatialConstraint
+from . import moc_utils
+
+# The times of the TMOCs are expressed in microseconds since the julian day 0 (TDB), the
+# way mocpy stores them. The ranges of a TMOC are handled by moc_utils like the ones of a MOC.
+DAY_MICRO_SEC = 86400000000
+# The order of the time cells of one microsecond in the ASCII serialization of the MOCs
+TIME_MAX_ORDER = 61
+
+
+def time_to_us(time):
+    """
+    Convert astropy times into microseconds since the julian day 0 (TDB)
+
+    The two parts of the julian dates are converted separately so that the
+    result is exact to the microsecond, which a float julian date is not.
+    """
+    time = time.tdb
+    day = np.floor(time.jd1)
+    fraction = (time.jd1 - day) + time.jd2
+    carry = np.floor(fraction)
+    day += carry
+    fraction -= carry
+    return day.astype(np.int64) * DAY_MICRO_SEC + np.floor(fraction * DAY_MICRO_SEC).astype(np.int64)
+
+
+def _as_time_ranges(tmoc):
+    if isinstance(tmoc, TimeRange):
+        return tmoc.time_ranges()
+    if isinstance(tmoc, TimeMoc):
+        return moc_utils.moc_to_ranges(tmoc)
+    return np.asarray(tmoc, dtype=np.int64).reshape(-1, 2)
+
+
+def _as_sky_ranges(region, order):
+    if isinstance(region, SpatialConstraint):
+        return region.healpix_ranges(order)
+    if isinstance(region, MOC):
+        return moc_utils.degrade_ranges(moc_utils.moc_to_ranges(region), order)
+    return moc_utils.degrade_ranges(np.asarray(region, dtype=np.int64).reshape(-1, 2), order)
+
+
+def _datasets_overlapping(store, ranges):
+    """The positions in a MocStore of the datasets whose ranges overlap the merged ``ranges``"""
+    store_ranges = np.asarray(store.ranges)
+    if len(ranges) == 0 or len(store_ranges) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # for each range of the store, the first range of ``ranges`` ending after its start
+    i = np.searchsorted(ranges[:, 1], store_ranges[:, 0], side='right')
+    hit = i < len(ranges)
+    hit[hit] = ranges[i[hit], 0] < store_ranges[hit, 1]
+    datasets = np.repeat(np.arange(len(store), dtype=np.int64), np.diff(np.asarray(store.offsets)))
+    return np.unique(datasets[hit])
+
+
+class TemporalConstraint(ABC):
+    """
+    This abstract class provides an interface for temporal constraints
+
+    A temporal constraint keeps the datasets whose time coverage (TMOC) overlaps
+    the period(s) it defines. It can be given to the MOCServer along with a
+    spatial constraint or evaluated locally on a MocStore of TMOCs.
+    """
+
+    @abstractmethod
+    def __init__(self):
+        self.request_payload = {}
+
+    @abstractmethod
+    def query_store(self, tmoc_store, moc_store=None):
+        """
+        IDs of the datasets matching the constraint, evaluated on a MocStore of TMOCs
+
+        Parameters
+        ----------
+        tmoc_store : MocStore
+            The store of the TMOCs of the datasets
+        moc_store : MocStore, optional
+            The store of the MOCs of the same datasets, required by the space-time constraints
+
+        Returns
+        -------
+        ids : [str]
+        """
+
+    def __repr__(self, *args, **kwargs):
+        result = "Temporal constraint having request payload :\n{0}".format(self.request_payload)
+        return result
+
+
+class TimeRange(TemporalConstraint):
+    def __init__(self, start, end):
+        """
+        Construct a constraint keeping the datasets observed between two dates
+
+        The period is sent to the MOCServer through its TIME parameter, as MJDs.
+
+        Parameters
+        ----------
+        start, end : `~astropy.time.Time`
+            The bounds of the period, inclusive
+
+        Exceptions
+        ----------
+        ValueError :
+            - start must not be after end
+        """
+        super(TimeRange, self).__init__()
+        if not isinstance(start, Time) or not isinstance(end, Time):
+            raise TypeError
+        if start > end:
+            print("The start of the time range must not be after its end")
+            raise ValueError
+
+        self.start = start
+        self.end = end
+        self.request_payload.update({
+            'TIME': '{0!r} {1!r}'.format(float(start.tdb.mjd), float(end.tdb.mjd))
+        })
+
+    def time_ranges(self):
+        """The range of the period, in microseconds, with an exclusive end like the ranges of mocpy"""
+        return np.array([[time_to_us(self.start), time_to_us(self.end) + 1]], dtype=np.int64)
+
+    def query_store(self, tmoc_store, moc_store=None):
+        positions = _datasets_overlapping(tmoc_store, self.time_ranges())
+        return [tmoc_store.ids[i] for i in positions.tolist()]
+
+
+class SpaceTimeMoc(TemporalConstraint):
+    def __init__(self, pairs, order=10):
+        """
+        Construct a space-time constraint from pairs of (periods, sky region)
+
+        A dataset matches the constraint if it has been observed in one of the sky
+        regions during the corresponding periods. The constraint is sent to the MOCServer
+        as a space-time MOC serialized in ASCII, uploaded the same way as a MOC file.
+        It cannot be combined with a spatial constraint.
+
+        Parameters
+        ----------
+        pairs : [(TimeRange or TimeMoc, SpatialConstraint or MOC)]
+            The periods and the sky regions, the periods being TimeRanges, TMOCs
+            or arrays of time ranges and the regions being Cones, Polygons, MOCs
+            or arrays of ranges
+        order : int
+            The HEALPix order at which the sky regions are expressed
+        """
+        super(SpaceTimeMoc, self).__init__()
+        if not pairs:
+            print("A space-time MOC needs at least one (period, sky region) pair")
+            raise ValueError
+
+        self.order = order
+        self.pairs = [(_as_time_ranges(tmoc), _as_sky_ranges(region, order)) for tmoc, region in pairs]
+        self.request_payload.update({
+            'moc': self.to_ascii().encode('ascii'),
+            'intersect': 'overlaps',
+        })
+
+    def normalized_pairs(self):
+        """
+        The pairs of the constraint with sorted and disjoint time ranges
+
+        The time axis is split at every bound of the periods. Each segment gets the union
+        of the sky regions of the pairs whose periods cover it, and the adjacent segments
+        having the same sky region are merged.
+
+        Returns
+        -------
+        pairs : [(`~numpy.ndarray`, `~numpy.ndarray`)]
+            The time ranges, one per pair, and the sky ranges of each pair
+        """
+        time_ranges_l = [moc_utils.merge_ranges(time_ranges) for time_ranges, _ in self.pairs]
+        edges = np.unique(np.concatenate([time_ranges.ravel() for time_ranges in time_ranges_l]))
+        # the pairs whose periods cover each segment [edges[i], edges[i + 1])
+        covered = [moc_utils.ranges_contain(time_ranges, edges[:-1]) for time_ranges in time_ranges_l]
+
+        segments = []
+        for i, (start, end) in enumerate(zip(edges[:-1].tolist(), edges[1:].tolist())):
+            sky_ranges = [pair[1] for pair, pair_covered in zip(self.pairs, covered) if pair_covered[i]]
+            if not sky_ranges:
+                continue
+            sky_ranges = moc_utils.merge_ranges(np.concatenate(sky_ranges))
+            if len(sky_ranges) == 0:
+                continue
+
+            if segments and segments[-1][0][1] == start and np.array_equal(segments[-1][1], sky_ranges):
+                segments[-1][0][1] = end
+            else:
+                segments.append(([start, end], sky_ranges))
+
+        return [(np.array([time_range], dtype=np.int64), sky_ranges) for time_range, sky_ranges in segments]
+
+    def to_ascii(self):
+        """
+        The constraint as a space-time MOC in the ASCII serialization of the MOC 2.0 standard
+
+        The pairs are normalized first, the time sets of a space-time MOC having to be
+        sorted and disjoint.
+        """
+        shift = 2 * (moc_utils.MAX_ORDER - self.order)
+        tokens = []
+        for time_ranges, sky_ranges in self.normalized_pairs():
+            tokens.append('t{0}/{1}'.format(TIME_MAX_ORDER, ' '.join(
+                '{0}-{1}'.format(start, end - 1) for start, end in time_ranges.tolist())))
+            tokens.append('s{0}/{1}'.format(self.order, ' '.join(
+                '{0}-{1}'.format(start, end - 1) for start, end in (sky_ranges >> shift).tolist())))
+        return ' '.join(tokens)
+
+    def query_store(self, tmoc_store, moc_store=None):
+        """
+        IDs of the datasets matching the constraint, evaluated on the TMOCs and MOCs of the datasets
+
+        Without the space-time MOCs of the datasets, a dataset matches a pair if its TMOC
+        overlaps the periods and its MOC overlaps the sky region, even if the observations
+        made during the periods lie elsewhere : the result contains the datasets returned
+        by the MOCServer and possibly a few more.
+        """
+        if moc_store is None:
+            print("The MOCs of the datasets are required to evaluate a space-time constraint")
+            raise ValueError
+
+        matches = set()
+        for time_ranges, sky_ranges in self.pairs:
+            for i in _datasets_overlapping(tmoc_store, time_ranges).tolist():
+                dataset_id = tmoc_store.ids[i]
+                if dataset_id not in matches and dataset_id in moc_store and \
+                        moc_utils.ranges_overlap(np.asarray(moc_store.ranges_of(dataset_id)), sky_ranges):
+                    matches.add(dataset_id)
+        return [dataset_id for dataset_id in tmoc_store.ids if dataset_id in matches]
@@ -1,6 +1,7 @@
 import os
 
 def get_package_data():
-    paths_test = [os.path.join('data', '*.json')]
+    paths_test = [os.path.join('data', '*.json'),
+                  os.path.join('data', '*.fits')]
 
     return {'cds.tests': paths_test}
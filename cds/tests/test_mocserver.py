@@ -1,21 +1,50 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 import pytest
 import os
+import requests
 import json
+import pickle
+import threading
+import warnings
+import io
+import glob
 from sys import getsizeof
 
+import numpy as np
+
 from ..core import cds, CdsClass
 
 from ..constraints import Constraints
 from ..spatial_constraints import *
 from ..property_constraint import *
 from ..output_format import *
+from ..moc_store import MocStore, harvest_mocs
+from .. import moc_utils, conf
+from ..coverage_index import CoverageIndex
+from ..mirror import CatalogueMirror, SyncReport
+from ..property_types import PropertyType, PropertyTypeRegistry
+from ..dataset import Dataset
+from ..pager import ResultPager
+from ..rate_limit import AdaptiveLimiter
+from .. import bulk
+from ..crossmatch import coverage_matrix
+from ..moc_cache import MocPyramidCache
+from ..moc_reduction import combine_mocs, IncrementalCoverage
+from ..search_cache import SearchCache
+from ..binary_votable import decode_votable, BINARY2_MIME_TYPE
+from ..temporal_constraints import TimeRange, SpaceTimeMoc
 
 from astroquery.utils.testing_tools import MockResponse
 
 from astropy import coordinates
+from astropy.table import Table, MaskedColumn
+from astropy.io import votable, fits
+from astropy import units as u
+from astropy.time import Time
+import pyvo as vo
 from regions import CircleSkyRegion, PolygonSkyRegion
-from mocpy import MOC
+from mocpy import MOC, TimeMoc
+from astropy_healpix import HEALPix
 
 DATA_FILES = {
     'CONE_SEARCH': 'cone_search.json',
@@ -39,19 +68,36 @@ def init_request():
 
 
 @pytest.fixture
-def patch_get(request):
-    try:
-        mp = request.getfixturevalue("monkeypatch")
-    except AttributeError:  # pytest < 3
-        mp = request.getfuncargvalue("monkeypatch")
-    mp.setattr(CdsClass, '_request', get_mockreturn)
-    return mp
+def mock_server(monkeypatch):
+    """
+    Answer the requests sent by CdsClass instead of the MOCServer
 
+    ``mock_server(handler)`` makes each request call ``handler(params, **kwargs)``, which
+    returns the content of the response (bytes), an object serialized in JSON or a
+    MockResponse. A handler that is not callable is the answer to every request.
+    """
+    def serve(handler):
+        def request(self, method, url, params=None, **kwargs):
+            result = handler(params, **kwargs) if callable(handler) else handler
+            if isinstance(result, MockResponse):
+                return result
+            if not isinstance(result, bytes):
+                result = json.dumps(result).encode('utf-8')
+            return MockResponse(result)
+        monkeypatch.setattr(CdsClass, '_request', request)
+    return serve
 
-def get_mockreturn(method, url, params=None, timeout=10, **kwargs):
+
+@pytest.fixture
+def patch_get(mock_server):
+    mock_server(get_mockreturn)
+    return mock_server
+
+
+def get_mockreturn(params, **kwargs):
     filename = data_path(DATA_FILES[params['get']])
-    content = open(filename, 'rb').read()
-    return MockResponse(content)
+    with open(filename, 'rb') as f_in:
+        return f_in.read()
 
 
 @pytest.fixture
@@ -208,6 +254,45 @@ def test_cone_search_spatial_request(RA, DEC, RADIUS):
            (request_payload['SR'] == str(RADIUS))
 
 
+def test_cone_radius_unit():
+    # SR is sent in degrees whatever the unit of the radius
+    center = coordinates.SkyCoord(ra=10.8, dec=6.5, unit="deg")
+    cone = Cone(CircleSkyRegion(center, coordinates.Angle(6, unit="arcmin")))
+    assert cone.request_payload['SR'] == '0.1'
+
+    # the region of a cone can be changed after its creation
+    cone.circle_region = CircleSkyRegion(center, coordinates.Angle(36, unit="arcsec"))
+    assert cone.request_payload['SR'] == '0.01'
+    assert cone.circle_region.radius.to_value(u.arcsec) == 36
+
+
+def test_cones_from_arrays():
+    centers = coordinates.SkyCoord([10.8, 25.6, 150.6], [6.5, -23.2, 45.1], unit="deg")
+    cones = Cone.from_arrays(centers, coordinates.Angle([0.5, 1.1, 1.5], unit="deg"), intersect="covers")
+
+    assert len(cones) == 3
+    for i, cone in enumerate(cones):
+        single_cone = Cone(CircleSkyRegion(centers[i], cones.radius[i]), intersect="covers")
+        assert cone.request_payload == single_cone.request_payload
+        assert cone.circle_region.center.ra.deg == centers[i].ra.deg
+
+    # slicing a collection gives a smaller collection
+    assert [cone.request_payload for cone in cones[1:]] == [cones[1].request_payload, cones[2].request_payload]
+
+    request_payloads = cds.query_regions(cones, get_query_payload=True)
+    assert [p['RA'] for p in request_payloads] == ['10.8', '25.6', '150.6']
+    assert all(p['get'] == 'id' for p in request_payloads)
+
+
+def test_query_regions(mock_server):
+    mock_server(lambda params, **kwargs: ['CDS/' + params['RA']])
+
+    centers = coordinates.SkyCoord(np.arange(20.), np.zeros(20), unit="deg")
+    results = cds.query_regions(Cone.from_arrays(centers, coordinates.Angle(0.1, unit="deg")), max_workers=4)
+
+    assert results == [['CDS/' + str(float(ra))] for ra in range(20)]
+
+
 @pytest.mark.parametrize('poly, poly_payload',
                          [(polygon1, 'Polygon 57.376 24.053 56.391 24.622 56.025 24.049 56.616 24.291'),
                           (polygon2, 'Polygon 58.376 24.053 53.391 25.622 56.025 22.049 54.616 27.291')])
@@ -223,6 +308,23 @@ def test_polygon_spatial_request(poly, poly_payload, init_request):
     assert request_payload['stc'] == poly_payload
 
 
+def test_polygon_simplify_tolerance():
+    # a circle of radius 1 deg sampled with many vertices and a small ripple on it
+    t = np.linspace(0, 2 * np.pi, 5000, endpoint=False)
+    vertices = coordinates.SkyCoord(150 + np.cos(t) + 1e-4 * np.sin(40 * t), 2 + np.sin(t), unit="deg")
+    poly = PolygonSkyRegion(vertices=vertices)
+
+    full_stc = Polygon(poly).request_payload['stc']
+    simplified_stc = Polygon(poly, simplify_tolerance=coordinates.Angle(30, unit="arcsec")).request_payload['stc']
+
+    n_full = (len(full_stc.split()) - 1) // 2
+    n_simplified = (len(simplified_stc.split()) - 1) // 2
+    assert n_full == 5000
+    assert 3 <= n_simplified < n_full / 10
+    # The first vertex of the polygon is always kept
+    assert simplified_stc.split()[1:3] == full_stc.split()[1:3]
+
+
 @pytest.mark.parametrize('intersect',
                          ['enclosed', 'overlaps', 'covers'])
 def test_intersect_param(intersect, cone_spatial_constraint):
@@ -276,6 +378,608 @@ def test_max_rec_param(moc_order, moc_spatial_constraint):
     assert isinstance(result, MOC)
 
 
+@pytest.mark.parametrize('moc_format', [OutputFormat.Type.moc, OutputFormat.Type.i_moc])
+def test_fits_moc_serialization(moc_format, cone_spatial_constraint, mock_server):
+    filename = data_path('moc.fits')
+
+    def mock_request(params, **kwargs):
+        assert params['fmt'] == 'fits'
+        return open(filename, 'rb').read()
+    mock_server(mock_request)
+
+    output_format = OutputFormat(format=moc_format, moc_order=10, moc_serialization='fits')
+    result = cds.query_region(Constraints(sc=cone_spatial_constraint), output_format)
+
+    assert result == MOC.from_moc_fits_file(filename)
+
+
+def test_moc_pyramid_cache(cone_spatial_constraint, mock_server):
+    filename = data_path('moc.fits')
+    orders = []
+
+    def mock_request(params, **kwargs):
+        orders.append(params['order'])
+        moc = MOC.from_moc_fits_file(filename)
+        return moc.degrade_to_order(min(params['order'], moc.max_order)).write(format='json')
+    mock_server(mock_request)
+
+    client = CdsClass()
+    # the MOCs are only cached on demand
+    assert client.moc_cache is None
+    client.moc_cache = MocPyramidCache(max_ranges=10 ** 6)
+    constraints = Constraints(sc=cone_spatial_constraint)
+    deep = client.query_region(constraints, OutputFormat(format=OutputFormat.Type.moc, moc_order=10))
+    for order in (5, 8, 10):
+        moc = client.query_region(constraints, OutputFormat(format=OutputFormat.Type.moc, moc_order=order))
+        assert moc == deep.degrade_to_order(order)
+    assert orders == [10]
+
+    # a deeper order is requested from the server and replaces the cached MOC
+    client.query_region(constraints, OutputFormat(format=OutputFormat.Type.moc, moc_order=11))
+    client.query_region(constraints, OutputFormat(format=OutputFormat.Type.moc, moc_order=10))
+    assert orders == [10, 11]
+    # the intersection MOCs are not cached
+    client.query_region(constraints, OutputFormat(format=OutputFormat.Type.i_moc, moc_order=5))
+    assert orders == [10, 11, 5]
+
+    # the least recently used pyramids are evicted
+    client.moc_cache.max_ranges = client.moc_cache.n_ranges
+    other_constraints = Constraints(sc=cone_spatial_constraint, pc=PropertyConstraint('ID=*'))
+    client.query_region(other_constraints, OutputFormat(format=OutputFormat.Type.moc, moc_order=10))
+    assert len(client.moc_cache) == 1
+    client.query_region(constraints, OutputFormat(format=OutputFormat.Type.moc, moc_order=5))
+    assert orders == [10, 11, 5, 10, 5]
+
+
+def test_json_moc_parsing():
+    moc = MOC.from_moc_fits_file(data_path('moc.fits'))
+    json_moc = moc.write(format='json')
+
+    assert CdsClass.create_mocpy_object_from_json(json_moc) == moc
+
+
+def test_harvest_mocs(tmpdir, mock_server):
+    mocs = {
+        'CDS/moc': data_path('moc.fits'),
+        'CDS/moc2': data_path('moc2.fits'),
+    }
+
+    def mock_request(params, **kwargs):
+        assert params['get'] == 'moc' and params['order'] == 8
+        dataset_id = params['expr'].split('=')[1]
+        return open(mocs[dataset_id], 'rb').read()
+    mock_server(mock_request)
+
+    store = harvest_mocs(str(tmpdir.join('store')), moc_order=8,
+                         dataset_ids=['CDS/moc2', 'CDS/moc'], max_workers=2)
+
+    # the store is read again from the disk
+    store = pickle.loads(pickle.dumps(store))
+    assert store.ids == ['CDS/moc2', 'CDS/moc']
+    assert 'CDS/moc' in store and 'CDS/unknown' not in store
+    assert isinstance(store.ranges, np.memmap)
+    assert store.moc('CDS/moc') == MOC.from_moc_fits_file(mocs['CDS/moc'])
+    moc2_uniq = moc_utils.uniq_from_fits(open(mocs['CDS/moc2'], 'rb').read())
+    assert np.array_equal(store.ranges_of('CDS/moc2'), moc_utils.uniq_to_ranges(moc2_uniq))
+
+
+def test_mocpy_private_layout():
+    # moc_utils reads and writes the private interval set of the mocpy objects
+    json_moc = {'5': [1, 2, 3, 40], '7': [1000, 1001]}
+    moc = MOC.from_json(json_moc)
+    ranges = moc_utils.json_to_ranges(json_moc)
+    assert moc_utils.moc_to_ranges(moc).tolist() == ranges.tolist()
+
+    moc_from_ranges = moc_utils.ranges_to_moc(ranges)
+    assert moc_from_ranges == moc
+    assert moc_from_ranges.to_uniq_interval_set().intervals == moc.to_uniq_interval_set().intervals
+    assert moc_from_ranges.union(MOC.from_json({'5': [4]})) == MOC.from_json({'5': [1, 2, 3, 4, 40], '7': [1000, 1001]})
+
+    # the NUNIQ column of a FITS MOC is read in place from the content
+    with open(data_path('moc.fits'), 'rb') as f_in:
+        content = f_in.read()
+    uniq = moc_utils.uniq_from_fits(content)
+    assert np.shares_memory(uniq, np.frombuffer(content, dtype=np.uint8))
+    assert moc_utils.uniq_to_ranges(uniq).tolist() == \
+        moc_utils.moc_to_ranges(MOC.from_moc_fits_file(data_path('moc.fits'))).tolist()
+    with pytest.raises(ValueError):
+        moc_utils.uniq_from_fits(content[:2880])
+    with pytest.raises(ValueError), warnings.catch_warnings():
+        # astropy warns about the truncated content
+        warnings.simplefilter('ignore')
+        moc_utils.uniq_from_fits(content[:6000])
+
+
+@pytest.fixture
+def random_cone_store(tmpdir):
+    """A MocStore containing the MOCs of random cones"""
+    rng = np.random.RandomState(0)
+    centers = coordinates.SkyCoord(rng.uniform(0, 360, 50), rng.uniform(-60, 60, 50), unit="deg")
+    cones = Cone.from_arrays(centers, coordinates.Angle(rng.uniform(0.5, 20, 50), unit="deg"))
+    mocs = [('CDS/{0}'.format(i), cone.healpix_ranges(8)) for i, cone in enumerate(cones)]
+    return MocStore.write(str(tmpdir.join('store')), mocs, moc_order=8)
+
+
+@pytest.mark.parametrize('intersect', ['overlaps', 'covers', 'enclosed'])
+def test_coverage_index_query_region(intersect, random_cone_store):
+    store = random_cone_store
+    index = CoverageIndex.build(store, order=3)
+
+    rng = np.random.RandomState(1)
+    for _ in range(10):
+        center = coordinates.SkyCoord(rng.uniform(0, 360), rng.uniform(-60, 60), unit="deg")
+        region = Cone(CircleSkyRegion(center, coordinates.Angle(rng.uniform(0.1, 10), unit="deg")),
+                      intersect=intersect)
+        region_ranges = region.healpix_ranges(store.moc_order)
+
+        if intersect == 'overlaps':
+            expected = [i for i in store.ids if moc_utils.ranges_overlap(store.ranges_of(i), region_ranges)]
+        elif intersect == 'covers':
+            expected = [i for i in store.ids if moc_utils.ranges_include(store.ranges_of(i), region_ranges)]
+        else:
+            expected = [i for i in store.ids if moc_utils.ranges_include(region_ranges, store.ranges_of(i))]
+
+        assert sorted(index.query_region(region)) == sorted(expected)
+
+
+def test_healpix_ranges(monkeypatch):
+    # a cone covering the whole sky leaves no border cell to refine
+    cone = Cone(CircleSkyRegion(coordinates.SkyCoord(10, 10, unit='deg'), coordinates.Angle(200, unit='deg')))
+    assert np.array_equal(cone.healpix_ranges(6), [[0, 12 * 4 ** 29]])
+
+    # the cells only crossed by an edge of a thin polygon are part of its coverage
+    vertices = coordinates.SkyCoord([10, 14, 10], [0, 0, 0.02], unit='deg')
+    polygon = Polygon(PolygonSkyRegion(vertices))
+    cells = moc_utils.ranges_to_cells(polygon.healpix_ranges(8), 8)
+    xyz = vertices.cartesian.xyz.value.T
+    t = np.linspace(0, 1, 10000)[:, None]
+    edges = np.concatenate([(1 - t) * xyz[i - 1] + t * xyz[i] for i in range(3)])
+    edges = coordinates.SkyCoord(*edges.T, representation_type='cartesian')
+    touched = HEALPix(nside=2 ** 8, order='nested').lonlat_to_healpix(edges.spherical.lon, edges.spherical.lat)
+    assert np.all(np.isin(touched, cells))
+
+    # the coverage of a MOC constraint is the MOC itself
+    moc = MOC.from_moc_fits_file(data_path('moc.fits'))
+    expected = moc_utils.degrade_ranges(moc_utils.moc_to_ranges(moc), 6)
+    assert np.array_equal(Moc.from_file(data_path('moc.fits')).healpix_ranges(6), expected)
+    assert np.array_equal(Moc.from_mocpy_object(moc).healpix_ranges(6), expected)
+
+    # a MOC given by its url is downloaded once, with a timeout and through the shared limiter
+    downloads = []
+
+    def mock_get(url, **kwargs):
+        downloads.append((url, kwargs.get('timeout')))
+        with open(data_path('moc.fits'), 'rb') as f_in:
+            return MockResponse(f_in.read())
+    monkeypatch.setattr('requests.get', mock_get)
+    moc_from_url = Moc.from_url('http://moc-host.org/moc.fits')
+    requests_before = cds.limiter.stats().get('moc-host.org')
+    assert np.array_equal(moc_from_url.healpix_ranges(6), expected)
+    assert np.array_equal(moc_from_url.healpix_ranges(5), moc_utils.degrade_ranges(expected, 5))
+    assert downloads == [('http://moc-host.org/moc.fits', conf.timeout)]
+    assert requests_before is None and cds.limiter.stats()['moc-host.org'].requests == 1
+    assert SpaceTimeMoc([(TimeRange(Time('2010-01-01'), Time('2010-02-01')), Moc.from_file(data_path('moc.fits')))],
+                        order=6).pairs[0][1].tolist() == expected.tolist()
+
+
+def test_coverage_index_query_positions(random_cone_store, tmpdir):
+    store = random_cone_store
+    index = CoverageIndex.build(store, order=3)
+    filename = str(tmpdir.join('index.npz'))
+    index.save(filename)
+    index = CoverageIndex.load(filename, store)
+
+    rng = np.random.RandomState(2)
+    positions = coordinates.SkyCoord(rng.uniform(0, 360, 100), rng.uniform(-60, 60, 100), unit="deg")
+    ipix = HEALPix(nside=2 ** 29, order='nested').lonlat_to_healpix(positions.ra, positions.dec)
+
+    results = index.query_positions(positions)
+    for i in range(len(positions)):
+        expected = [d for d in store.ids if moc_utils.ranges_contain(store.ranges_of(d), ipix[i])]
+        assert sorted(results[i]) == sorted(expected)
+
+    assert index.query_position(positions[0]) == results[0]
+
+
+@pytest.mark.parametrize('n_processes', [1, 2])
+def test_coverage_matrix(n_processes, random_cone_store):
+    store = random_cone_store
+    rng = np.random.RandomState(3)
+    positions = coordinates.SkyCoord(rng.uniform(0, 360, 200), rng.uniform(-60, 60, 200), unit="deg")
+    ipix = HEALPix(nside=2 ** 29, order='nested').lonlat_to_healpix(positions.ra, positions.dec)
+
+    matrix = coverage_matrix(positions, store, chunk_size=64, n_processes=n_processes)
+    assert matrix.shape == (200, len(store))
+    for i in range(len(positions)):
+        assert matrix[i] == [d for d in store.ids if moc_utils.ranges_contain(store.ranges_of(d), ipix[i])]
+
+    # the MOCs can also be given as mocpy objects
+    mocs = dict((d, moc_utils.ranges_to_moc(np.asarray(store.ranges_of(d)))) for d in store.ids[:10])
+    sub_matrix = coverage_matrix(positions, mocs)
+    assert [sub_matrix[i] for i in range(len(positions))] == \
+        [[d for d in matrix[i] if d in mocs] for i in range(len(positions))]
+    assert list(sub_matrix.sources_of('CDS/3')) == \
+        [i for i in range(len(positions)) if 'CDS/3' in sub_matrix[i]]
+
+
+@pytest.mark.parametrize('n_processes', [1, 2])
+def test_combine_mocs(n_processes, random_cone_store):
+    store = random_cone_store
+    # the datasets overlapping the first one, so that the intersection is not empty
+    ids = [d for d in store.ids if moc_utils.ranges_overlap(store.ranges_of(d), store.ranges_of('CDS/0'))]
+    mocs = [moc_utils.ranges_to_moc(np.asarray(store.ranges_of(d))) for d in store.ids]
+
+    expected_union = mocs[0]
+    for moc in mocs[1:]:
+        expected_union = expected_union.union(moc)
+    union = combine_mocs(store.ids, 'union', n_processes=n_processes, store=store)
+    assert moc_utils.ranges_to_moc(union) == expected_union
+    assert np.array_equal(combine_mocs(mocs, 'union', n_processes=n_processes), union)
+
+    expected_intersection = mocs[0].intersection(mocs[store.position(ids[1])])
+    intersection = combine_mocs(ids[:2], 'intersection', store=store)
+    assert len(intersection) > 0
+    assert moc_utils.ranges_to_moc(intersection) == expected_intersection
+
+
+def test_incremental_coverage(random_cone_store):
+    store = random_cone_store
+    coverage = IncrementalCoverage(store)
+    ids = [d for d in store.ids if moc_utils.ranges_overlap(store.ranges_of(d), store.ranges_of('CDS/0'))]
+
+    for dataset_ids in (store.ids[:20], store.ids[10:30], ids[:2], ids[1:3], []):
+        coverage.update(dataset_ids)
+        assert sorted(coverage.dataset_ids) == sorted(dataset_ids)
+        assert np.array_equal(coverage.union(), combine_mocs(dataset_ids, 'union', store=store))
+        assert np.array_equal(coverage.intersection(), combine_mocs(dataset_ids, 'intersection', store=store))
+
+
+def test_query_moc_from_store(random_cone_store, mock_server):
+    store = random_cone_store
+    ids = store.ids[5:15]
+    mock_server(ids)
+
+    constraints = Constraints(pc=PropertyConstraint('ID=*'))
+    moc = cds.query_moc_from_store(constraints, store, OutputFormat(format=OutputFormat.Type.moc, moc_order=6))
+    assert moc_utils.moc_to_ranges(moc).tolist() == \
+        moc_utils.degrade_ranges(combine_mocs(ids, 'union', store=store), 6).tolist()
+
+    # the MOCs are degraded before being intersected
+    i_moc = cds.query_moc_from_store(constraints, store, OutputFormat(format=OutputFormat.Type.i_moc, moc_order=6))
+    degraded = [moc_utils.degrade_ranges(store.ranges_of(dataset_id), 6) for dataset_id in ids]
+    expected = combine_mocs(degraded, 'intersection')
+    assert moc_utils.moc_to_ranges(i_moc).tolist() == expected.tolist()
+    assert combine_mocs(ids, 'intersection', store=store, n_processes=2, order=6).tolist() == expected.tolist()
+
+
+def test_query_i_moc_from_store_lower_order(tmpdir, mock_server):
+    # two disjoint cells of order 8 lying in the same cell of order 6
+    shift = 2 * (29 - 8)
+    mocs = [('CDS/a', np.array([[0, 1 << shift]])), ('CDS/b', np.array([[1 << shift, 2 << shift]]))]
+    store = MocStore.write(str(tmpdir.join('store')), mocs, moc_order=8)
+    mock_server(['CDS/a', 'CDS/b'])
+
+    constraints = Constraints(pc=PropertyConstraint('ID=*'))
+    i_moc = cds.query_moc_from_store(constraints, store, OutputFormat(format=OutputFormat.Type.i_moc, moc_order=6))
+    # the intersection of the degraded MOCs is the cell of order 6, not an empty MOC
+    assert moc_utils.moc_to_ranges(i_moc).tolist() == [[0, 1 << (2 * (29 - 6))]]
+
+
+class FakeMocServer(object):
+    """Answers the record/id queries of the MOCServer from a dict of records"""
+
+    def __init__(self, records):
+        self.records = records
+        self.requests = []
+
+    def match(self, expr, record):
+        if ' && ' in expr:
+            return all(self.match(sub_expr.strip('()'), record) for sub_expr in expr.split(' && '))
+        if ' || ' in expr:
+            return any(self.match(sub_expr, record) for sub_expr in expr.split(' || '))
+        if '>' in expr:
+            key, value = expr.split('>')
+            return key in record and record[key] > value
+        key, value = expr.split('=')
+        return value == '*' or record.get(key) == value
+
+    def __call__(self, params, **kwargs):
+        self.requests.append(params)
+        # the MOCServer lists the datasets sorted by ID
+        matches = [record for _, record in sorted(self.records.items()) if self.match(params['expr'], record)]
+        if params['get'] == 'number':
+            return {'number': len(matches)}
+        if params['get'] == 'id':
+            return [record['ID'] for record in matches]
+        if 'fields' in params:
+            # only the requested fields are returned
+            fields = params['fields'].split(', ')
+            matches = [dict((k, v) for k, v in record.items() if k in fields) for record in matches]
+        return matches[:int(params.get('MAXREC', len(matches)))]
+
+
+def test_catalogue_mirror_sync(tmpdir, mock_server):
+    records = dict(('CDS/{0}'.format(i), {'ID': 'CDS/{0}'.format(i), 'moc_release_date': '2018-01-0{0}T10:00Z'.format(i)})
+                   for i in range(1, 6))
+    server = FakeMocServer(records)
+    mock_server(server)
+
+    mirror = CatalogueMirror(str(tmpdir.join('mirror')))
+    report = mirror.sync()
+    assert report.added == sorted(records.keys()) and not report.updated and not report.deleted
+    assert mirror.high_water_mark == '2018-01-05T10:00Z'
+
+    # update a record, add two records (one without a date) and delete one
+    records['CDS/2']['moc_release_date'] = '2018-02-01T10:00Z'
+    records['CDS/6'] = {'ID': 'CDS/6', 'moc_release_date': '2018-02-02T10:00Z'}
+    records['CDS/7'] = {'ID': 'CDS/7'}
+    del records['CDS/3']
+    server.requests = []
+
+    mirror = CatalogueMirror(str(tmpdir.join('mirror')))
+    report = mirror.sync()
+    assert report == SyncReport(['CDS/6', 'CDS/7'], ['CDS/2'], ['CDS/3'])
+    assert mirror.high_water_mark == '2018-02-02T10:00Z'
+    assert sorted(mirror.datasets().keys()) == sorted(records.keys())
+    assert mirror.records['CDS/2']['moc_release_date'] == '2018-02-01T10:00Z'
+    # only the changed records have been downloaded
+    assert [params['expr'] for params in server.requests if params['get'] == 'record'] == \
+        ['moc_release_date>2018-01-05T10:00Z', 'ID=CDS/7']
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_result_pager(prefetch, mock_server):
+    records = dict(('CDS/{0:02d}'.format(i), {'ID': 'CDS/{0:02d}'.format(i), 'obs_title': str(i)})
+                   for i in reversed(range(23)))
+    server = FakeMocServer(records)
+    mock_server(server)
+
+    constraints = Constraints(pc=PropertyConstraint('ID=*'))
+    # listing a pager does not probe the number of datasets twice
+    assert len(list(ResultPager(constraints, page_size=10, prefetch=prefetch))) == 3
+    assert [params['get'] for params in server.requests].count('number') == 1
+    # the pages are pulled with MAXREC after the last ID of the previous page, without listing all the IDs
+    assert [(params['expr'], params['MAXREC']) for params in server.requests if params['get'] == 'record'] == \
+        [('ID=*', '10'), ('(ID=*) && ID>CDS/09', '10'), ('(ID=*) && ID>CDS/19', '10')]
+    assert 'id' not in [params['get'] for params in server.requests]
+
+    server.requests = []
+    pager = ResultPager(constraints, field_l=['obs_title'], page_size=10, prefetch=prefetch)
+    assert pager.count() == 23
+    assert pager.count() == 23
+    assert [params['get'] for params in server.requests].count('number') == 1
+
+    pages = []
+    for page in pager:
+        pages.append(list(page.keys()))
+        if len(pages) == 2:
+            # the first page is processed, not the second one
+            assert pager.cursor == 'CDS/09'
+            break
+
+    assert pages == [sorted(records.keys())[:10], sorted(records.keys())[10:20]]
+    # the ID is always retrieved, to index the datasets
+    assert sorted(page['CDS/15'].properties.keys()) == ['ID', 'obs_title']
+
+    # resume after the last processed page
+    resumed = ResultPager(constraints, page_size=10, prefetch=prefetch, cursor=pager.cursor)
+    pages = [list(page.keys()) for page in resumed]
+    assert pages == [sorted(records.keys())[10:20], sorted(records.keys())[20:]]
+    assert resumed.cursor == 'CDS/22'
+
+
+def test_adaptive_limiter():
+    limiter = AdaptiveLimiter(initial_concurrency=8, max_retries=2, backoff_base=0.)
+    url = 'http://alasky.unistra.fr/MocServer/query'
+
+    statuses = [503, 503, 200]
+    response = limiter.call(url, lambda: MockResponse(b'', status_code=statuses.pop(0)))
+    assert response.status_code == 200
+    stats = limiter.stats()['alasky.unistra.fr']
+    assert (stats.requests, stats.errors, stats.retries) == (3, 2, 2)
+    # each failure halved the concurrency limit and the success increased it
+    assert stats.concurrency_limit == 2.5
+    assert stats.in_flight == 0
+
+    # the errors that are not caused by an overload are not retried
+    def fail():
+        raise ValueError
+    with pytest.raises(ValueError):
+        limiter.call(url, fail)
+    assert limiter.stats()['alasky.unistra.fr'].requests == 4
+
+
+def test_adaptive_limiter_connection_errors():
+    limiter = AdaptiveLimiter(max_retries=2, backoff_base=0.)
+    calls = []
+
+    def unreachable():
+        calls.append(None)
+        raise requests.exceptions.ConnectionError('Name or service not known')
+
+    def timeout():
+        calls.append(None)
+        raise requests.exceptions.ReadTimeout('Read timed out')
+
+    # a host that cannot be reached is not retried, unlike a host too slow to answer
+    with pytest.raises(requests.exceptions.ConnectionError):
+        limiter.call('http://unknown.org/tap', unreachable)
+    assert len(calls) == 1
+    with pytest.raises(requests.exceptions.Timeout):
+        limiter.call('http://slow.org/tap', timeout)
+    assert len(calls) == 4
+
+
+def test_bulk_run(tmpdir, mock_server):
+    def mock_request(params, **kwargs):
+        # the targets of the northern hemisphere lie in one dataset
+        return [{'ID': 'CDS/north', 'obs_title': 'North'}] if float(params['DEC']) > 0 else []
+    mock_server(mock_request)
+
+    targets = str(tmpdir.join('targets.csv'))
+    with open(targets, 'w') as f_out:
+        f_out.write('name,ra,dec\n')
+        for i, dec in enumerate([10, -10, 20, 30, -40]):
+            f_out.write('t{0},{1},{2}\n'.format(i, 10 * i, dec))
+
+    output_dir = str(tmpdir.join('output'))
+    args = [targets, output_dir, '--radius', '0.5', '--fields', 'obs_title', '--chunk-size', '2',
+            '--output-format', 'fits']
+    assert bulk.main(args) == 3
+
+    parts = [Table.read(os.path.join(output_dir, 'part-{0:05d}.fits'.format(i))) for i in range(3)]
+    assert [list(part['target']) for part in parts] == [[0], [2, 3], []]
+    assert list(parts[1]['obs_title']) == ['North', 'North']
+
+    # the chunks already written are skipped
+    assert bulk.main(args) == 0
+
+
+@pytest.mark.parametrize('search, size_param, size', [('cs', 'radius', 0.01), ('sia', 'size', 0.02),
+                                                      ('ssa', 'diameter', 0.02)])
+def test_bulk_search(search, size_param, size, tmpdir, mock_server, monkeypatch):
+    requests_params = []
+
+    def mock_request(params, **kwargs):
+        requests_params.append(params)
+        return [{'ID': 'CDS/all', '{0}_service_url'.format(search): 'http://{0}.org/all?'.format(search)}]
+    mock_server(mock_request)
+
+    searches = []
+
+    class MockResults(object):
+        def __init__(self, kwargs):
+            searches.append(kwargs)
+            self.votable = votable.from_table(Table({'ra': [1.5]}))
+
+    service_class = {'cs': vo.dal.SCSService, 'sia': vo.dal.SIAService, 'ssa': vo.dal.SSAService}[search]
+    monkeypatch.setattr(service_class, 'search', lambda service, **kwargs: MockResults(kwargs))
+    monkeypatch.setattr(Dataset, 'search_cache', None)
+
+    targets = str(tmpdir.join('targets.csv'))
+    with open(targets, 'w') as f_out:
+        f_out.write('ra,dec\n10,10\n')
+    output_dir = str(tmpdir.join('output'))
+    assert bulk.run(targets, output_dir, 0.5, search=search, search_radius=0.01, output_format='fits') == 1
+
+    # the same region is searched whatever the service
+    assert [kwargs[size_param].to_value(u.deg) for kwargs in searches] == [pytest.approx(size)]
+    # the URL of the service is retrieved with the records, which are not fetched again
+    assert len(requests_params) == 1
+    assert '{0}_service_url'.format(search) in requests_params[0]['fields'].split(', ')
+
+
+def test_bulk_run_parquet(tmpdir, mock_server):
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    mock_server([{'ID': 'CDS/all', 'obs_title': 'All'}])
+
+    targets = str(tmpdir.join('targets.csv'))
+    with open(targets, 'w') as f_out:
+        f_out.write('ra,dec\n10,10\n20,-20\n30,30\n')
+
+    output_dir = str(tmpdir.join('output'))
+    assert bulk.run(targets, output_dir, 0.5, fields=['obs_title'], chunk_size=2) == 2
+
+    parts = [pyarrow_parquet.read_table(os.path.join(output_dir, 'part-{0:05d}.parquet'.format(i))).to_pydict()
+             for i in range(2)]
+    assert [part['target'] for part in parts] == [[0, 1], [2]]
+    assert parts[0]['ID'] == ['CDS/all', 'CDS/all'] and parts[1]['obs_title'] == ['All']
+
+
+def test_bulk_fits_targets(tmpdir):
+    targets = str(tmpdir.join('targets.fits'))
+    Table({'ra': [10., 20., 30.], 'dec': [1., 2., 3.]}).write(targets)
+    chunks = list(bulk.read_target_chunks(targets, 'ra', 'dec', 2))
+    assert [list(ra) for ra, dec, radius in chunks] == [[10., 20.], [30.]]
+
+    # a FITS file without any binary table
+    fits.PrimaryHDU().writeto(str(tmpdir.join('image.fits')))
+    with pytest.raises(ValueError):
+        list(bulk.read_target_chunks(str(tmpdir.join('image.fits')), 'ra', 'dec', 2))
+
+
+def test_property_type_registry():
+    registry = PropertyTypeRegistry()
+    record = registry.parse({
+        'ID': 'CDS/I/345/gaia2',
+        'moc_sky_fraction': '0.25',
+        'hips_order': ['11', '11'],
+        'tap_service_url': ['http://b.org', 'http://a.org', 'http://b.org', 'http://c.org'],
+    })
+
+    assert record == {
+        'ID': 'CDS/I/345/gaia2',
+        'moc_sky_fraction': 0.25,
+        'hips_order': 11.0,
+        # duplicates are removed and the order of the values is kept
+        'tap_service_url': ['http://b.org', 'http://a.org', 'http://c.org'],
+    }
+    assert registry['moc_sky_fraction'] is PropertyType.numeric
+    assert registry['ID'] is PropertyType.string
+
+    # the types are kept for the next records
+    record = registry.parse({'ID': '12', 'moc_sky_fraction': 'unknown'})
+    assert record == {'ID': '12', 'moc_sky_fraction': 'unknown'}
+
+
+def test_property_types_across_queries():
+    registry = PropertyTypeRegistry()
+
+    # an empty value does not tell the type of a property
+    assert registry.parse({'ID': 'CDS/1', 'obs_initial_ra': ''}) == {'ID': 'CDS/1', 'obs_initial_ra': ''}
+    assert 'obs_initial_ra' not in registry
+    assert registry.parse({'ID': 'CDS/2', 'obs_initial_ra': '10.5'})['obs_initial_ra'] == 10.5
+
+    # the types are kept for the next queries, a value which is not a number being kept as is
+    assert registry.parse({'ID': 'CDS/3', 'obs_initial_ra': ''})['obs_initial_ra'] == ''
+    assert registry.parse({'ID': 'CDS/4', 'obs_initial_ra': 'unknown'})['obs_initial_ra'] == 'unknown'
+    assert registry.parse({'ID': 'CDS/5', 'obs_initial_ra': '-3e2'})['obs_initial_ra'] == -300.0
+    assert CdsClass.property_types is cds.property_types
+
+
+def test_dataset_compact_properties():
+    d1 = Dataset(ID='CDS/1', moc_sky_fraction=0.1, cs_service_url='http://vizier.org/cs/1?')
+    d2 = Dataset(ID='CDS/2', moc_sky_fraction=0.2, cs_service_url='http://vizier.org/cs/2?')
+
+    assert d1.properties == {'ID': 'CDS/1', 'moc_sky_fraction': 0.1, 'cs_service_url': 'http://vizier.org/cs/1?'}
+    assert list(d2.properties.keys()) == ['ID', 'moc_sky_fraction', 'cs_service_url']
+    assert d1.services == ['cs']
+    # the table of the property names is shared between the two datasets
+    assert d1.properties._table is d2.properties._table
+
+    with pytest.raises(TypeError):
+        d1.properties['ID'] = 'CDS/3'
+    with pytest.raises(AttributeError):
+        d1.new_attribute = 0
+
+
+def test_lazy_records(mock_server):
+    records = dict(('CDS/{0}'.format(i), {'ID': 'CDS/{0}'.format(i), 'obs_title': 'title {0}'.format(i),
+                                          'obs_description': 'description {0}'.format(i),
+                                          'cs_service_url': 'http://vizier.org/cs/{0}?'.format(i)})
+                   for i in range(5))
+    server = FakeMocServer(records)
+    mock_server(server)
+
+    datasets = cds.query_region(Constraints(pc=PropertyConstraint('ID=*')),
+                                OutputFormat(format=OutputFormat.Type.record, lazy=True))
+    assert len(server.requests) == 1
+    assert set(server.requests[0]['fields'].split(', ')) == set(OutputFormat.LAZY_FIELDS)
+
+    # the default fields are read without any request
+    assert datasets['CDS/0'].properties['obs_title'] == 'title 0'
+    assert len(server.requests) == 1
+
+    # reading another property fetches the records of all the datasets at once
+    assert datasets['CDS/0'].properties['obs_description'] == 'description 0'
+    assert len(server.requests) == 2
+    assert server.requests[1]['expr'] == ' || '.join('ID=CDS/{0}'.format(i) for i in range(5))
+
+    assert dict(datasets['CDS/3'].properties) == records['CDS/3']
+    assert datasets['CDS/4'].services == ['cs']
+    assert len(server.requests) == 2
+
+
 # test of field_l when retrieving dataset records
 @pytest.mark.parametrize('field_l', [['ID'],
                                      ['ID', 'moc_sky_fraction'],
@@ -295,3 +999,302 @@ def test_field_l_param(field_l, cone_spatial_constraint):
                 at_least_one_field = True
                 break
         assert at_least_one_field
+
+
+def test_search_cache(tmpdir, monkeypatch):
+    searches = []
+
+    class MockResults(object):
+        def __init__(self, url, kwargs):
+            searches.append(url)
+            table = Table({'ra': [1.5, 2.5], 'name': ['a', 'b']})
+            self.votable = votable.from_table(table)
+
+    monkeypatch.setattr(vo.dal.SCSService, 'search', lambda service, **kwargs: MockResults(service.baseurl, kwargs))
+    # the searches are only cached on demand
+    assert Dataset.search_cache is None
+    monkeypatch.setattr(Dataset, 'search_cache', SearchCache(str(tmpdir.join('cache'))))
+
+    pos = coordinates.SkyCoord(10.5, 20.5, unit='deg')
+    mirror1 = Dataset(ID='CDS/1', moc_release_date='2018-01-01', cs_service_url='http://vizier.org/cs/1?')
+    result = mirror1.search(Dataset.ServiceType.cs, pos=pos, radius=0.1)
+    assert list(result.get_first_table().array['ra']) == [1.5, 2.5]
+
+    # the cache is shared by the mirrors and the parameters are compared by value :
+    # the same position in another frame or format and the same radius in another unit
+    mirror2 = Dataset(ID='CDS/1', moc_release_date='2018-01-01', cs_service_url='http://vizier2.org/cs/1?')
+    for same_pos, same_radius in [(pos.galactic, 0.1 * u.deg),
+                                  (coordinates.SkyCoord('0h42m +20d30m'), 6 * u.arcmin)]:
+        cached = mirror2.search(Dataset.ServiceType.cs, radius=same_radius, pos=same_pos)
+        assert list(cached.get_first_table().array['name']) == ['a', 'b']
+    assert searches == ['http://vizier.org/cs/1?']
+
+    # another position is not found in the cache
+    mirror2.search(Dataset.ServiceType.cs, radius=0.1, pos=coordinates.SkyCoord('0h42m -20d30m'))
+    assert searches == ['http://vizier.org/cs/1?', 'http://vizier2.org/cs/1?']
+
+    # a new release of the dataset invalidates its results
+    released = Dataset(ID='CDS/1', moc_release_date='2018-02-01', cs_service_url='http://vizier.org/cs/1?')
+    released.search(Dataset.ServiceType.cs, pos=pos, radius=0.1)
+    assert len(searches) == 3
+    assert len(os.listdir(str(tmpdir.join('cache')))) == 2
+
+    # the least recently read results are evicted
+    Dataset.search_cache.max_bytes = os.path.getsize(glob.glob(str(tmpdir.join('cache', '*')))[0])
+    released.search(Dataset.ServiceType.cs, pos=pos, radius=0.2)
+    assert len(os.listdir(str(tmpdir.join('cache')))) == 1
+    released.search(Dataset.ServiceType.cs, pos=pos, radius=0.2)
+    assert len(searches) == 4
+
+
+def test_search_cache_size(tmpdir, monkeypatch):
+    cache = SearchCache(str(tmpdir.join('cache')))
+    result = votable.from_table(Table({'ra': [1.5, 2.5]}))
+    old = Dataset(ID='CDS/1', moc_release_date='2018-01-01')
+    new = Dataset(ID='CDS/1', moc_release_date='2018-02-01')
+    for radius in range(3):
+        cache.put(old, Dataset.ServiceType.cs, {'radius': radius}, result)
+
+    scans = []
+    real_glob = glob.glob
+    monkeypatch.setattr('glob.glob', lambda pattern: scans.append(pattern) or real_glob(pattern))
+    # each miss deletes the previous version of its search, then the new version is written
+    for radius in range(5):
+        assert cache.get(new, Dataset.ServiceType.cs, {'radius': radius}) is None
+        cache.put(new, Dataset.ServiceType.cs, {'radius': radius}, result)
+    cache.put(new, Dataset.ServiceType.cs, {'radius': 0}, result)
+
+    # the size of the cache is kept without scanning the whole directory again
+    assert not [pattern for pattern in scans if os.path.basename(pattern) == '*' + SearchCache.EXTENSION]
+    files = real_glob(str(tmpdir.join('cache', '*')))
+    assert len(files) == 5
+    assert cache._SearchCache__size == sum(os.path.getsize(f) for f in files)
+
+
+def make_votable_content(tabledata_format='binary2'):
+    table = Table({'id': np.array([1, 2, 3], dtype=np.int64),
+                   'mag': MaskedColumn([1.5, 2.5, 3.5], mask=[False, True, False]),
+                   'name': ['x', 'yy', 'zzz'],
+                   'flag': [True, False, True],
+                   'pm': np.arange(6, dtype=np.int16).reshape(3, 2)})
+    table['mag'].unit = 'mag'
+    vot = votable.from_table(table)
+    vot.get_first_table().fields[2].datatype = 'char'
+    vot.get_first_table().fields[3].datatype = 'boolean'
+    content = io.BytesIO()
+    vot.to_xml(content, tabledata_format=tabledata_format)
+    return content.getvalue()
+
+
+@pytest.mark.parametrize('tabledata_format', ['binary2', 'tabledata'])
+def test_decode_votable(tabledata_format, monkeypatch):
+    content = make_votable_content(tabledata_format)
+    expected = votable.parse(io.BytesIO(content)).get_first_table().to_table()
+    if tabledata_format == 'tabledata':
+        # the element tree of the VOTables that are not in BINARY2 is not built
+        monkeypatch.setattr('xml.etree.ElementTree.fromstring', None)
+    table = decode_votable(content)
+
+    assert table.colnames == expected.colnames
+    for name in table.colnames:
+        mask = np.ma.getmaskarray(expected[name])
+        assert np.array_equal(np.ma.getmaskarray(table[name]), mask)
+        assert np.array_equal(np.ma.getdata(table[name])[~mask], np.ma.getdata(expected[name])[~mask])
+    assert table['mag'].unit == u.mag
+
+
+def test_decode_votable_error():
+    content = b"""<?xml version="1.0"?>
+<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">
+  <RESOURCE type="results"><INFO name="QUERY_STATUS" value="ERROR">Unknown table</INFO></RESOURCE>
+</VOTABLE>"""
+    with pytest.raises(vo.dal.DALQueryError):
+        decode_votable(content)
+
+
+def test_binary2_search(monkeypatch):
+    queries = []
+
+    class MockQuery(object):
+        def __init__(self, service, params):
+            self.query = params['query']
+            queries.append((service.baseurl, params.get('RESPONSEFORMAT')))
+
+        def execute_stream(self):
+            baseurl, response_format = queries[-1]
+            if 'text-only' in baseurl and response_format is not None:
+                raise vo.dal.DALQueryError('Unsupported RESPONSEFORMAT')
+            if 'broken' in baseurl or 'missing' in self.query:
+                raise vo.dal.DALQueryError('Unknown table')
+            return io.BytesIO(make_votable_content('binary2' if response_format else 'tabledata'))
+
+    monkeypatch.setattr(vo.dal.TAPService, 'create_query', lambda service, **params: MockQuery(service, params))
+    monkeypatch.setattr(Dataset, 'search_cache', None)
+
+    dataset = Dataset(ID='CDS/1', tap_service_url='http://binary.org/tap')
+    table = dataset.search(Dataset.ServiceType.tap, as_table=True, query='SELECT * FROM t')
+    assert list(table['name']) == ['x', 'yy', 'zzz']
+    assert queries == [('http://binary.org/tap', BINARY2_MIME_TYPE)]
+
+    # the service that cannot answer in BINARY2 is queried in TABLEDATA, then directly in TABLEDATA
+    dataset = Dataset(ID='CDS/2', tap_service_url='http://text-only.org/tap')
+    for _ in range(2):
+        table = dataset.search(Dataset.ServiceType.tap, as_table=True, query='SELECT * FROM t')
+        assert list(table['id']) == [1, 2, 3]
+    assert queries[1:] == [('http://text-only.org/tap', BINARY2_MIME_TYPE), ('http://text-only.org/tap', None),
+                           ('http://text-only.org/tap', None)]
+
+    # the other errors are raised without querying the service again in TABLEDATA
+    dataset = Dataset(ID='CDS/3', tap_service_url='http://binary.org/tap')
+    del queries[:]
+    with pytest.raises(vo.dal.DALQueryError):
+        dataset.search(Dataset.ServiceType.tap, as_table=True, query='SELECT * FROM missing')
+    assert queries == [('http://binary.org/tap', BINARY2_MIME_TYPE)]
+    # and the service is still asked for BINARY2
+    dataset.search(Dataset.ServiceType.tap, as_table=True, query='SELECT * FROM t')
+    assert queries[-1] == ('http://binary.org/tap', BINARY2_MIME_TYPE)
+
+    # a service failing in TABLEDATA too is asked for BINARY2 again by the next search
+    dataset = Dataset(ID='CDS/4', tap_service_url='http://text-only.org/broken/tap')
+    del queries[:]
+    for _ in range(2):
+        with pytest.raises(vo.dal.DALQueryError):
+            dataset.search(Dataset.ServiceType.tap, as_table=True, query='SELECT * FROM t')
+    assert [response_format for _, response_format in queries] == [BINARY2_MIME_TYPE, None] * 2
+
+    # the votables are requested in TABLEDATA, which astropy parses faster than BINARY2
+    searches = []
+
+    class MockResults(object):
+        votable = votable.from_table(Table({'ra': [1.5]}))
+
+    def search(service, **params):
+        searches.append(params)
+        return MockResults()
+
+    monkeypatch.setattr(vo.dal.TAPService, 'search', search)
+    dataset = Dataset(ID='CDS/5', tap_service_url='http://binary.org/tap')
+    assert dataset.search(Dataset.ServiceType.tap, query='SELECT * FROM t') is MockResults.votable
+    assert searches == [{'query': 'SELECT * FROM t'}]
+
+
+def test_coverage_pruning(tmpdir, monkeypatch):
+    searches = []
+    moc_urls = []
+    moc_threads = []
+
+    class MockResults(object):
+        def __init__(self, url, kwargs):
+            searches.append(url)
+            self.votable = votable.from_table(Table({'ra': [1.5]}))
+
+    def mock_get(url, **kwargs):
+        moc_urls.append(url)
+        moc_threads.append(threading.current_thread())
+        with open(data_path('moc.fits'), 'rb') as f:
+            return MockResponse(f.read())
+
+    monkeypatch.setattr(vo.dal.SCSService, 'search', lambda service, **kwargs: MockResults(service.baseurl, kwargs))
+    monkeypatch.setattr(Dataset, 'search_cache', None)
+    monkeypatch.setattr('requests.get', mock_get)
+
+    moc = MOC.from_moc_fits_file(data_path('moc.fits'))
+    inside = coordinates.SkyCoord(10.81, 4.97, unit='deg')
+    outside = coordinates.SkyCoord(200, -40, unit='deg')
+    ipix = HEALPix(nside=2 ** 29, order='nested').lonlat_to_healpix(inside.ra, inside.dec)
+    assert moc_utils.ranges_contain(moc_utils.moc_to_ranges(moc), [ipix])[0]
+
+    covered = Dataset(ID='CDS/1', cs_service_url='http://cs.org/1?')
+    covered.set_coverage(moc)
+    fetched = Dataset(ID='CDS/2', cs_service_url='http://cs.org/2?', moc_access_url='http://moc.org/2')
+    unknown = Dataset(ID='CDS/3', cs_service_url='http://cs.org/3?')
+
+    # the searches outside of the coverage are not sent
+    assert covered.search(Dataset.ServiceType.cs, prune=True, pos=outside, radius=0.05) is None
+    assert covered.search(Dataset.ServiceType.cs, prune=True, pos=inside, radius=0.05) is not None
+    assert not covered.may_match(Dataset.ServiceType.sia, pos=(200, -40), size=(0.1, 0.2))
+    assert covered.may_match(Dataset.ServiceType.ssa, pos=(10.81 * u.deg, 4.97 * u.deg), diameter=6 * u.arcmin)
+    assert covered.may_match(Dataset.ServiceType.tap, query='SELECT * FROM t')
+    assert searches == ['http://cs.org/1?']
+
+    # the coverage is fetched once from moc_access_url and the datasets without coverage are always searched
+    results = Dataset.search_many({'CDS/1': covered, 'CDS/2': fetched, 'CDS/3': unknown}, Dataset.ServiceType.cs,
+                                  pos=outside, radius=0.05)
+    assert results['CDS/1'] is None and results['CDS/2'] is None and results['CDS/3'] is not None
+    results = Dataset.search_many([covered, fetched], Dataset.ServiceType.cs, pos=inside, radius=0.05)
+    assert all(result is not None for result in results.values())
+    assert moc_urls == ['http://moc.org/2']
+    # the coverages are downloaded by the workers of the searches
+    assert moc_threads[0] is not threading.main_thread()
+    assert sorted(searches[1:]) == ['http://cs.org/1?', 'http://cs.org/2?', 'http://cs.org/3?']
+
+    # a MocStore gives the coverage of the datasets too
+    store = MocStore.write(str(tmpdir.join('store')), [('CDS/3', moc)], moc_order=10)
+    monkeypatch.setattr(Dataset, 'coverage_store', store)
+    stored = Dataset(ID='CDS/3', cs_service_url='http://cs.org/3?')
+    assert np.array_equal(stored.coverage, store.ranges_of('CDS/3'))
+    assert stored.search(Dataset.ServiceType.cs, prune=True, pos=outside, radius=0.05) is None
+
+
+def test_temporal_constraints(tmpdir, mock_server):
+    start, end = Time('2010-01-01', scale='tdb'), Time('2010-02-01T12:00:00', scale='tdb')
+    time_range = TimeRange(start, end)
+    cone = Cone(CircleSkyRegion(coordinates.SkyCoord(10, 10, unit='deg'), radius=coordinates.Angle(1, unit='deg')))
+    payload = cds.query_region(Constraints(sc=cone, tc=time_range), get_query_payload=True)
+    assert payload['TIME'] == '55197.0 55228.5' and payload['intersect'] == 'overlaps'
+
+    # the ranges are the ones of the TMOCs of mocpy
+    tmoc = TimeMoc()
+    tmoc.add_time_interval(start, end)
+    assert np.array_equal(time_range.time_ranges(), moc_utils.moc_to_ranges(tmoc))
+
+    with pytest.raises(ValueError):
+        TimeRange(end, start)
+
+    # a space-time MOC is uploaded and defines the sky region of the query
+    stmoc = SpaceTimeMoc([(time_range, cone)], order=6)
+    assert stmoc.to_ascii().startswith('t61/{0}-{1} s6/'.format(*time_range.time_ranges()[0] - [0, 1]))
+    with pytest.raises(ValueError):
+        Constraints(sc=cone, tc=stmoc)
+
+    uploads = []
+
+    def mock_request(params, files=None, **kwargs):
+        uploads.append(files['moc'].read())
+        return ['CDS/1']
+    mock_server(mock_request)
+    assert list(cds.query_region(Constraints(tc=stmoc), OutputFormat(format=OutputFormat.Type.id))) == ['CDS/1']
+    assert uploads == [stmoc.to_ascii().encode('ascii')]
+
+    # local evaluation on the TMOCs and MOCs of the datasets
+    def period(t1, t2):
+        tmoc = TimeMoc()
+        tmoc.add_time_interval(Time(t1, scale='tdb'), Time(t2, scale='tdb'))
+        return tmoc
+
+    tmocs = [('CDS/1', period('2009-01-01', '2010-01-15')), ('CDS/2', period('2011-01-01', '2012-01-01')),
+             ('CDS/3', period('2010-01-20', '2010-01-21'))]
+    tmoc_store = MocStore.write(str(tmpdir.join('tmocs')), tmocs, moc_order=29)
+    far = Cone(CircleSkyRegion(coordinates.SkyCoord(200, -40, unit='deg'), radius=coordinates.Angle(1, unit='deg')))
+    mocs = [('CDS/1', cone.healpix_ranges(8)), ('CDS/2', cone.healpix_ranges(8)), ('CDS/3', far.healpix_ranges(8))]
+    moc_store = MocStore.write(str(tmpdir.join('mocs')), mocs, moc_order=8)
+
+    assert time_range.query_store(tmoc_store) == ['CDS/1', 'CDS/3']
+    assert stmoc.query_store(tmoc_store, moc_store) == ['CDS/1']
+    assert SpaceTimeMoc([(time_range, far), (period('2011-06-01', '2011-07-01'), cone)]).query_store(
+        tmoc_store, moc_store) == ['CDS/2', 'CDS/3']
+
+
+def test_space_time_moc_overlapping_periods():
+    def cells(*ipix):
+        shift = 2 * (29 - 6)
+        return np.array([[i << shift, (i + 1) << shift] for i in ipix], dtype=np.int64)
+
+    # the later period is given first and overlaps the earlier one
+    stmoc = SpaceTimeMoc([(np.array([[50, 150]]), cells(2)), (np.array([[0, 100]]), cells(1))], order=6)
+    assert stmoc.to_ascii() == 't61/0-49 s6/1-1 t61/50-99 s6/1-2 t61/100-149 s6/2-2'
+
+    # the adjacent segments having the same sky region are merged
+    stmoc = SpaceTimeMoc([(np.array([[50, 150]]), cells(1)), (np.array([[0, 100], [200, 300]]), cells(1))],
+                         order=6)
+    assert stmoc.to_ascii() == 't61/0-149 s6/1-1 t61/200-299 s6/1-1'